@@ -15,6 +15,7 @@ setup(name='spigot',
           "pypump==0.6",
           "feedparser>=5.0",
           "argparse>=1.0",
+          "requests>=2.0",
           ],
       classifiers=["Development Status :: 5 - Production/Stable",
                    "Programming Language :: Python",
@@ -20,25 +20,509 @@
 
 # Standard library imports
 import argparse
+import calendar
+import contextlib
+import cProfile
 from datetime import datetime, timedelta
+import hashlib
+import heapq
+import importlib
 try:
     import json
 except ImportError:
     import simplejson as json
 import logging
 import os
+import pstats
+import Queue
 import re
+import shutil
+import signal
+import socket
 import sqlite3
+import struct
 import sys
-from time import mktime
+import threading
+from time import mktime, sleep, time
+import zlib
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+
+class LazyModule(object):
+    """Stands in for the named module, importing it when one of its
+    attributes is first used. Runs which have nothing to do then never pay
+    for importing it."""
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
 
 # 3rd-party modules
-import feedparser
-from pypump import PyPump
-from pypump import Client
+feedparser = LazyModule("feedparser")
+pypump = LazyModule("pypump")
+requests = LazyModule("requests")
 
 SPIGOT_VERSION = "2.3.0"
 
+# Global settings which may be overridden in the "settings" section of
+# spigot.json
+DEFAULT_SETTINGS = {
+    # Number of feeds fetched in parallel by poll_feeds
+    "poll_workers": 1,
+    # Seconds to wait on a feed's server before giving up on it
+    "poll_timeout": 30,
+    # Prune posted items older than this many days (None to keep all)
+    "retention_days": None,
+    # Prune all but this many of the latest posted items per feed
+    "retention_per_feed": None,
+    # Prune the database at the end of every run
+    "auto_prune": False,
+    # Minutes between polls of each feed in daemon mode
+    "poll_interval": 15,
+    # Store the raw fields of new items and format them only when posted
+    "render_at_post": False,
+    # Only process entries newer than the newest seen on the last poll
+    "incremental_scan": False,
+    # Answer link lookups from memory: None, "memory", or "file" to also
+    # keep the cache in spigot.db.links between runs
+    "link_cache": None,
+    # Number of accounts posted to in parallel by post_items
+    "post_workers": 1,
+    # Most accounts on the same pump.io server posted to at once
+    "post_host_limit": 2,
+    # Number of feed servers to keep connections open to
+    "http_pool_size": 10,
+    # Most connections to a single feed server at once
+    "http_host_limit": 4,
+    # Parse feeds incrementally, keeping only the fields used by formats
+    "streaming_parse": False,
+    # Write a JSON summary of the run's counters and timings to this file
+    "metrics_file": None,
+    # Write the metrics in the Prometheus text format to this file
+    "metrics_textfile": None,
+    # Serve the metrics at http://127.0.0.1:<port>/metrics in daemon mode
+    "metrics_port": None,
+    # Minutes between polls of each feed when run from cron (None to poll
+    # every feed on every run)
+    "cron_poll_interval": None,
+    # Where feeds are configured: "json" in spigot.json, or "sqlite" in a
+    # table of spigot.db
+    "config_backend": "json",
+    # Poll each feed about as often as it has had new items, within the
+    # bounds below, rather than every poll_interval or cron_poll_interval
+    "adaptive_polling": False,
+    # Fewest and most minutes between adaptive polls of a feed
+    "poll_min_interval": 15,
+    "poll_max_interval": 1440,
+    # Number of worker processes sharing the feeds, each run with --worker
+    "workers": 1,
+    # Seconds a worker's claim on a feed lasts unless renewed, which should
+    # be longer than a run takes
+    "lease_seconds": 600,
+    # Minutes to wait before retrying an item which could not be posted,
+    # doubled after each further failure up to retry_max_delay
+    "retry_delay": 5,
+    "retry_max_delay": 1440,
+    # Give up on an item after this many failed attempts (None to keep
+    # retrying)
+    "retry_limit": 10,
+    # Consecutive failed polls after which a feed is left alone for
+    # breaker_delay minutes before it is tried again, doubled after each
+    # further failure up to breaker_max_delay
+    "breaker_threshold": 3,
+    "breaker_delay": 15,
+    "breaker_max_delay": 1440,
+    # Store the messages of new items zlib-compressed where that makes them
+    # smaller
+    "compress_messages": False,
+}
+
+
+# Fields in message formats are names surrounded by '%', e.g. %title%
+FORMAT_FIELD_RE = re.compile(r"%(\w+)%")
+
+
+def compile_format(form):
+    """Split the given message format into a tuple alternating between
+    literal text and field names, e.g. "%title% - %link%" becomes
+    ("", "title", " - ", "link", "")."""
+
+    return tuple(FORMAT_FIELD_RE.split(form))
+
+
+# Elements of RSS and Atom entries read by iter_entries, mapped to the names
+# feedparser gives them. Other elements keep their own name.
+ENTRY_ELEMENTS = {
+    "guid": "id",
+    "pubDate": "published",
+    "issued": "published",
+    "date": "published",
+    "modified": "updated",
+    "description": "summary",
+    "encoded": "content",
+    "creator": "author",
+}
+
+
+def iter_entries(source, fields=()):
+    """Generate the entries of the RSS or Atom feed read from the file-like
+    source one at a time, without holding the whole feed in memory. Each
+    entry is a FeedParserDict like feedparser's, holding the entry's id,
+    link, title and dates plus any of the other fields named in fields."""
+
+    wanted = set(fields)
+    wanted.update(["id", "link", "title"])
+    stack = []
+    entry = None
+    for event, elem in ElementTree.iterparse(source, ("start", "end")):
+        name = elem.tag.rsplit("}", 1)[-1]
+        if event == "start":
+            if name in ("item", "entry"):
+                entry = feedparser.FeedParserDict()
+            stack.append(elem)
+            continue
+        stack.pop()
+        if entry is None:
+            continue
+        if name in ("item", "entry"):
+            yield entry
+            entry = None
+            # Drop the finished entry from the tree to bound memory use
+            elem.clear()
+            if stack:
+                stack[-1].remove(elem)
+            continue
+        parent = stack[-1].tag.rsplit("}", 1)[-1]
+        if parent == "author" and name == "name":
+            # Atom nests the author's name within the author element
+            name = "author"
+        elif parent not in ("item", "entry") or len(elem):
+            continue
+        key = ENTRY_ELEMENTS.get(name, name)
+        text = (elem.text or "").strip()
+        if key == "link":
+            # Atom links are attributes, of which only one is the entry's
+            if elem.get("href") is not None:
+                if elem.get("rel", "alternate") == "alternate":
+                    entry["link"] = elem.get("href")
+            elif text:
+                entry["link"] = text
+        elif key in ("published", "updated"):
+            if key not in entry:
+                entry[key] = text
+                entry[key + "_parsed"] = feedparser._parse_date(text)
+        elif key == "content":
+            if key in wanted:
+                entry[key] = [feedparser.FeedParserDict(value=text)]
+        elif key in wanted:
+            entry[key] = text
+
+
+def iter_chunks(iterable, size):
+    "Generate lists of up to size consecutive items from iterable."
+
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def link_hash(link):
+    """Return a compact 60-bit integer hash of the given link, used to
+    remember the links of items pruned from the database, by the link cache
+    and to assign feeds to workers."""
+
+    if isinstance(link, unicode):
+        link = link.encode("utf-8")
+    return int(hashlib.sha1(link).hexdigest()[:15], 16)
+
+
+def to_epoch(date):
+    """Return the given naive UTC datetime as whole seconds since the epoch,
+    as times are stored in the items table, or None."""
+
+    if date is None:
+        return None
+    return calendar.timegm(date.utctimetuple())
+
+
+def from_epoch(seconds):
+    "Return the naive UTC datetime of the given seconds since the epoch."
+
+    if seconds is None:
+        return None
+    return datetime.utcfromtimestamp(seconds)
+
+
+class SpigotMetrics():
+    """Counters and timing histograms of each stage of a run, kept per feed.
+    In daemon mode they accumulate over the life of the process."""
+
+    # Upper bounds in seconds of the timing histogram buckets
+    buckets = (0.001, 0.01, 0.1, 1, 10, 60)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.counters = {}
+        self.timings = {}
+
+    def incr(self, name, feed, value=1):
+        """Add value to the named counter of the given feed."""
+
+        self._lock.acquire()
+        try:
+            key = (name, feed)
+            self.counters[key] = self.counters.get(key, 0) + value
+        finally:
+            self._lock.release()
+
+    def observe(self, stage, feed, seconds):
+        """Record that the given stage took seconds for the given feed."""
+
+        self._lock.acquire()
+        try:
+            timing = self.timings.get((stage, feed))
+            if timing is None:
+                timing = [0, 0.0] + [0] * len(self.buckets)
+                self.timings[(stage, feed)] = timing
+            timing[0] += 1
+            timing[1] += seconds
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    timing[2 + i] += 1
+        finally:
+            self._lock.release()
+
+    @contextlib.contextmanager
+    def timer(self, stage, feed):
+        """Time the body of a with statement as the given stage."""
+
+        start = time()
+        try:
+            yield
+        finally:
+            self.observe(stage, feed, time() - start)
+
+    def summary(self):
+        """Return the counters and timings as a dict, keyed by name and then
+        by feed."""
+
+        self._lock.acquire()
+        try:
+            counters = {}
+            for (name, feed), value in self.counters.items():
+                counters.setdefault(name, {})[feed] = value
+            timings = {}
+            for (stage, feed), timing in self.timings.items():
+                buckets = dict(zip([str(b) for b in self.buckets],
+                                   timing[2:]))
+                timings.setdefault(stage, {})[feed] = {
+                    "count": timing[0], "sum": timing[1],
+                    "buckets": buckets}
+        finally:
+            self._lock.release()
+        return {"counters": counters, "timings": timings}
+
+    def prometheus(self):
+        """Return the counters and timings in the Prometheus text format."""
+
+        def label(value):
+            value = value.replace("\\", "\\\\").replace('"', '\\"')
+            return value.replace("\n", "\\n")
+
+        lines = []
+        self._lock.acquire()
+        try:
+            for name in sorted(set(key[0] for key in self.counters)):
+                metric = "spigot_%s_total" % name
+                lines.append("# TYPE %s counter" % metric)
+                for (key, feed), value in sorted(self.counters.items()):
+                    if key == name:
+                        lines.append('%s{feed="%s"} %d' %
+                                     (metric, label(feed), value))
+            if self.timings:
+                metric = "spigot_stage_seconds"
+                lines.append("# TYPE %s histogram" % metric)
+            for (stage, feed), timing in sorted(self.timings.items()):
+                labels = 'stage="%s",feed="%s"' % (stage, label(feed))
+                for bound, count in zip(self.buckets, timing[2:]):
+                    lines.append('%s_bucket{%s,le="%s"} %d' %
+                                 (metric, labels, bound, count))
+                lines.append('%s_bucket{%s,le="+Inf"} %d' %
+                             (metric, labels, timing[0]))
+                lines.append("%s_sum{%s} %f" % (metric, labels, timing[1]))
+                lines.append("%s_count{%s} %d" % (metric, labels, timing[0]))
+        finally:
+            self._lock.release()
+        return "\n".join(lines) + "\n"
+
+    def export(self, config):
+        """Write the metrics to the files named in the metrics_file and
+        metrics_textfile settings. Each file is replaced atomically so that
+        readers never see a partial one."""
+
+        outputs = [(config.get_setting("metrics_file"),
+                    lambda: json.dumps(self.summary(), indent=4,
+                                       sort_keys=True)),
+                   (config.get_setting("metrics_textfile"), self.prometheus)]
+        for path, render in outputs:
+            if not path:
+                continue
+            tmp_path = "%s.tmp" % path
+            try:
+                out = open(tmp_path, "w")
+                out.write(render())
+                out.close()
+                os.rename(tmp_path, path)
+            except (IOError, OSError):
+                logging.exception("Unable to write metrics to %s", path)
+
+    def log_summary(self):
+        """Log the total of each counter and the time spent in each stage."""
+
+        summary = self.summary()
+        for name, feeds in sorted(summary["counters"].items()):
+            logging.info("Metric %s: %d", name, sum(feeds.values()))
+        for stage, feeds in sorted(summary["timings"].items()):
+            logging.info("Stage %s: %.3fs over %d calls", stage,
+                         sum(t["sum"] for t in feeds.values()),
+                         sum(t["count"] for t in feeds.values()))
+
+
+def serve_metrics(port):
+    """Serve the metrics on the given local port from a background thread,
+    in the Prometheus text format at /metrics and as JSON at /metrics.json.
+    Returns the server."""
+
+    import BaseHTTPServer
+
+    class SpigotMetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path == "/metrics":
+                body = metrics.prometheus()
+                content_type = "text/plain; version=0.0.4"
+            elif self.path == "/metrics.json":
+                body = json.dumps(metrics.summary(), sort_keys=True)
+                content_type = "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug("Metrics request: " + format, *args)
+
+    server = BaseHTTPServer.HTTPServer(("127.0.0.1", port),
+                                       SpigotMetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    logging.info("Serving metrics on port %d", server.server_port)
+    return server
+
+
+# Metrics shared by every part of a run
+metrics = SpigotMetrics()
+
+
+# Libraries whose share of a profiled run is reported by profile_run, with
+# tests of the file and name of each profiled function for whether it is
+# part of the library
+PROFILE_LIBRARIES = [
+    ("feedparser",
+     lambda filename, name: "feedparser" in os.path.basename(filename)),
+    ("sqlite3", lambda filename, name: "sqlite3" in filename + name),
+    ("pypump", lambda filename, name: "pypump" in filename),
+]
+
+
+def profile_breakdown(stats):
+    """Return the total time spent in each of the PROFILE_LIBRARIES from the
+    given pstats.Stats, as a list of (library, seconds) tuples. A library's
+    time is the cumulative time of the calls spigot makes into it directly,
+    so calls back into the library from elsewhere are not counted twice."""
+
+    def from_spigot(filename):
+        return os.path.splitext(os.path.basename(filename))[0] == "spigot"
+
+    breakdown = []
+    for library, test in PROFILE_LIBRARIES:
+        seconds = 0.0
+        for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+            if not test(func[0], func[2]):
+                continue
+            for caller, caller_stats in callers.items():
+                if from_spigot(caller[0]):
+                    seconds += caller_stats[3]
+        breakdown.append((library, seconds))
+    return breakdown
+
+
+def profile_run(func, path, top=25, out=sys.stderr):
+    """Run func under cProfile, saving the profile to path for later study
+    with pstats and writing a report of the top functions by cumulative time
+    and of the time spent in each of the PROFILE_LIBRARIES to out. Only the
+    calling thread is profiled. Returns the result of func."""
+
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func)
+    finally:
+        profiler.dump_stats(path)
+        stats = pstats.Stats(path, stream=out)
+        out.write("Profile saved to %s\n\n" % path)
+        out.write("Time spent in libraries of %.3fs total:\n" %
+                  stats.total_tt)
+        for library, seconds in profile_breakdown(stats):
+            out.write("  %-12s %8.3fs\n" % (library, seconds))
+        stats.sort_stats("cumulative").print_stats(top)
+
+
+def feed_worker(url, workers):
+    """Return the index of the worker, out of the given number of workers,
+    which handles the feed at url. The same feed always goes to the same
+    worker for as long as the number of workers is unchanged."""
+
+    return link_hash(url) % workers
+
+
+def claim_feeds(config, db):
+    """Lease the feeds assigned to config's worker, renewing the leases this
+    worker already holds, and limit config to the feeds whose lease it holds.
+    A feed leased by another process, such as an overlapping run of the same
+    worker, is left alone until its lease expires. Return True if the leased
+    feeds have changed."""
+
+    workers = config.get_setting("workers")
+    assigned = [url for url in config.get("feeds", {})
+                if feed_worker(url, workers) == config.worker]
+    leased = db.acquire_leases(assigned, config.lease_owner,
+                               config.get_setting("lease_seconds"))
+    logging.debug("Worker %d holds leases on %d of %d assigned feeds",
+                  config.worker, len(leased), len(assigned))
+    return config.set_leased(leased)
+
 
 def simple_verifier(url):
     print 'Please follow the instructions at the following URL:'
@@ -46,13 +530,63 @@ def simple_verifier(url):
     return raw_input("Verifier: ")
 
 
+class SpigotAccounts(dict):
+    """Extends the built-in dict type to cache PyPump connections keyed on
+    account webfinger, so that each account is set up at most once for the
+    life of the process however many feeds post to it.
+    """
+
+    def __init__(self):
+        dict.__init__(self)
+        # Posting threads may ask for connections at the same time
+        self._lock = threading.Lock()
+
+    def get_pump(self, webfinger):
+        """Return the PyPump connection for the given account, creating and
+        authorizing it on first use."""
+
+        self._lock.acquire()
+        try:
+            if webfinger not in self:
+                logging.debug("Connecting to account %s", webfinger)
+                client = pypump.Client(
+                    webfinger=webfinger,
+                    type="native",
+                    name="Spigot")
+                self[webfinger] = pypump.PyPump(
+                    client=client,
+                    verifier_callback=simple_verifier)
+            return self[webfinger]
+        finally:
+            self._lock.release()
+
+
 class SpigotConfig(dict):
     """Extends the built-in dict type to provide a configuration interface for
     Spigot, keeping track of feeds polled and accounts configured for posting.
+
+    Settings are always kept in spigot.json. With the sqlite config backend,
+    feeds are kept in the database at db_path instead, so that one feed can
+    be added or changed without rewriting the others.
     """
 
-    def __init__(self, path="spigot.json"):
+    def __init__(self, path="spigot.json", db_path="spigot.db"):
         self.config_file = path
+        self.db_path = db_path
+        # Account connections survive reloads of the configuration
+        self.accounts = SpigotAccounts()
+        # Incremented on each load or change of a feed so that users can drop
+        # cached state
+        self.generation = 0
+        # Database holding the feeds with the sqlite backend
+        self._store = None
+        # (generation, feeds) from the last call to get_feeds
+        self._feeds_cache = None
+        # In multi-worker mode, this process's worker index, the name it
+        # takes leases under and the set of feeds it holds leases on
+        self.worker = None
+        self.lease_owner = None
+        self.leased = None
         self.no_config = True
         if os.path.exists(self.config_file):
             self.no_config = False
@@ -74,25 +608,145 @@ class SpigotConfig(dict):
         """Load the spigot json config file from the working directory
         and import it into the SpigotConfig dict object."""
 
-        logging.debug("Loading %s" % self.config_file)
+        logging.debug("Loading %s", self.config_file)
         # Start with a clean configuration object
         self.clear()
+        self.generation += 1
         try:
             self.update(json.loads(open(self.config_file, "r").read()))
         except IOError:
             logging.warning("Could not load configuration file")
+        store = self.get_store()
+        if store is not None:
+            if self.get("feeds"):
+                logging.warning("Ignoring the feeds in %s, which may be \
+imported with --import-config", self.config_file)
+            self["feeds"] = store.get_feed_configs()
+
+    def get_store(self):
+        """Return the SpigotDB holding the feeds if the sqlite config backend
+        is in use, connecting on first use, or None."""
+
+        if self.get_setting("config_backend") != "sqlite":
+            return None
+        if self._store is None:
+            self._store = SpigotDB(self.db_path)
+        return self._store
 
-    def save(self):
-        "Convert the state of the SpigotConfig dict to json and save."
+    def _write(self, path, config):
+        """Write the given configuration to path as json, replacing any
+        existing file atomically so that it is never seen half written."""
 
-        logging.debug("Saving %s" % self.config_file)
+        tmp_path = "%s.tmp" % path
+        out = open(tmp_path, "w")
+        out.write(json.dumps(config, indent=4))
+        out.close()
+        os.rename(tmp_path, path)
+
+    def save(self):
+        """Convert the state of the SpigotConfig dict to json and save. With
+        the sqlite backend, the feeds are saved to the database instead."""
+
+        logging.debug("Saving %s", self.config_file)
+        config = dict(self)
+        store = self.get_store()
+        if store is not None:
+            store.set_feed_configs(config.pop("feeds", {}))
         try:
-            open(self.config_file, "w").write(json.dumps(self, indent=4))
+            self._write(self.config_file, config)
             return True
-        except IOError:
+        except (IOError, OSError):
             logging.exception("Could not save configuration file")
             sys.exit(2)
 
+    def set_feed(self, url, feed):
+        """Add or replace the configuration of the given feed and save it.
+        With the sqlite backend only this feed is written."""
+
+        self.setdefault("feeds", {})[url] = feed
+        self.generation += 1
+        store = self.get_store()
+        if store is not None:
+            store.set_feed_configs({url: feed})
+        else:
+            self.save()
+
+    def remove_feed(self, url):
+        """Remove the configuration of the given feed and save it. Return
+        False if the feed is not configured. Its items are left in the
+        database."""
+
+        if url not in self.get("feeds", {}):
+            return False
+        del self["feeds"][url]
+        self.generation += 1
+        store = self.get_store()
+        if store is not None:
+            store.delete_feed_config(url)
+        else:
+            self.save()
+        return True
+
+    def import_feeds(self, path):
+        """Add the feeds configured in the json file at path, replacing any
+        with the same URL, and save them. Return the number imported."""
+
+        feeds = json.loads(open(path, "r").read()).get("feeds", {})
+        self.setdefault("feeds", {}).update(feeds)
+        self.generation += 1
+        store = self.get_store()
+        if store is not None:
+            store.set_feed_configs(feeds)
+        else:
+            self.save()
+        logging.info("Imported %d feeds from %s", len(feeds), path)
+        return len(feeds)
+
+    def export(self, path):
+        """Write the settings and feeds to path in the json format of
+        spigot.json, whichever backend holds the feeds."""
+
+        self._write(path, self)
+        logging.info("Exported %d feeds to %s", len(self.get("feeds", {})),
+                     path)
+
+    def get_stamp(self):
+        """Return a value which changes whenever the configuration file, or
+        the feeds held in the database by the sqlite backend, change."""
+
+        try:
+            mtime = os.path.getmtime(self.config_file)
+        except OSError:
+            mtime = None
+        store = self.get_store()
+        if store is None:
+            return mtime
+        return (mtime, store.get_feed_config_stamp())
+
+    def get_setting(self, name):
+        """Return the configured value of the named global setting, or its
+        default from DEFAULT_SETTINGS if it is not configured."""
+
+        return self.get("settings", {}).get(name, DEFAULT_SETTINGS[name])
+
+    def get_retention(self):
+        """Return a tuple of the maximum age of posted items as a timedelta
+        and the number of posted items to keep per feed, either of which is
+        None if not set, as passed to SpigotDB.prune."""
+
+        max_age = None
+        retention_days = self.get_setting("retention_days")
+        if retention_days:
+            max_age = timedelta(days=retention_days)
+        return max_age, self.get_setting("retention_per_feed")
+
+    def prunes_db(self):
+        """Return True if the database is to be pruned after each run. Workers
+        share one database, which only the first of them prunes."""
+
+        return (self.get_setting("auto_prune") and
+                self.worker in (None, 0))
+
     def add_feed(self):
         "Add a feed, account, interval, and format to the configuration."
 
@@ -108,18 +762,14 @@ class SpigotConfig(dict):
         test_feed = None
         try:
             test_feed = feedparser.parse(url)
-            logging.debug("Successfully parsed feed %s" % url)
+            logging.debug("Successfully parsed feed %s", url)
         except:
-            logging.warning("Could not parse feed %s" % url)
+            logging.warning("Could not parse feed %s", url)
         account = raw_input("Account Webfinger ID (e.g. bob@example.com): ")
         # Verify that the account is valid
         # PyPump will authorize the account if necessary
-        client = Client(
-            webfinger=account,
-            name="Spigot",
-            type="native")
         try:
-            pump = PyPump(client, verifier_callback=simple_verifier)
+            pump = self.accounts.get_pump(account)
             print pump.me
         except:
             logging.exception("Could not verify account")
@@ -155,42 +805,77 @@ class SpigotConfig(dict):
         feed["format"] = form
         feed["title"] = title
 
-        if "feeds" in self:
-            self["feeds"][url] = feed
-        else:
-            feeds = {}
-            feeds[url] = feed
-            self["feeds"] = feeds
+        self.set_feed(url, feed)
+
+    def set_worker(self, worker):
+        """Run as the worker with the given index, handling only the feeds
+        leased with claim_feeds."""
+
+        self.worker = worker
+        self.lease_owner = "%s:%d:%d" % (socket.gethostname(), os.getpid(),
+                                         worker)
+        self.set_leased([])
 
-        self.save()
+    def set_leased(self, feeds):
+        """Limit this process to the given feeds, returning True if they
+        differ from those it was limited to before."""
+
+        leased = set(feeds)
+        if leased == self.leased:
+            return False
+        self.leased = leased
+        self.generation += 1
+        return True
+
+    def handles_feed(self, url):
+        """Return True if the given feed is configured and, in multi-worker
+        mode, leased by this worker."""
+
+        if url not in self.get("feeds", {}):
+            return False
+        return self.leased is None or url in self.leased
 
     def get_feeds(self):
-        """Sets instance variable 'feeds' of feeds to check for new posts.
-        Formatted in a tuple in the form of (url, account, interval, format)
-        """
-
-        feeds = self["feeds"]
-        feeds_to_poll = []
-        feeds_num = len(feeds)
-        logging.debug("Found %d feeds in configuration" % feeds_num)
-        for url in feeds.keys():
-            logging.debug("Processing feed %s" % url)
-            account = feeds[url]["account"]
-            logging.debug("  Account: %s" % account)
-            interval = feeds[url]["interval"]
-            logging.debug("  Interval: %s min" % interval)
-            form = feeds[url]["format"]
-            logging.debug("  Format: %s" % form)
-            feeds_to_poll.append((url, account, interval, form))
-            logging.debug("  Added to list of feeds to poll")
-        return feeds_to_poll
+        """Return a list of the feeds to check for new posts, as tuples in the
+        form of (url, account, interval, format). The list is built once for
+        each generation of the configuration and must not be modified."""
+
+        if (self._feeds_cache is None or
+                self._feeds_cache[0] != self.generation):
+            feeds = self["feeds"]
+            logging.debug("Found %d feeds in configuration", len(feeds))
+            feeds_to_poll = [(url, feed["account"], feed["interval"],
+                              feed["format"])
+                             for url, feed in feeds.items()
+                             if self.handles_feed(url)]
+            self._feeds_cache = (self.generation, feeds_to_poll)
+        return self._feeds_cache[1]
 
 
 class SpigotDB():
     """Handle database calls for Spigot."""
 
+    # Version of the database schema, stored in sqlite's user_version pragma.
+    # Databases with an older version are upgraded in place on connect by
+    # running each of the _upgrade_to_<version> methods in turn.
+    SCHEMA_VERSION = 13
+    # Partial indexes, with a WHERE clause, need sqlite 3.8.0 or later
+    PARTIAL_INDEXES = sqlite3.sqlite_version_info >= (3, 8, 0)
+
     def __init__(self, path="spigot.db"):
         self.path = path
+        # Set of link hashes when the link cache is enabled
+        self._links = None
+        self._links_file = None
+        # State of the database when the link cache was built or loaded
+        self._links_marker = None
+        self._data_version = None
+        # Owner of the leases taken through this connection, given up on close
+        self._lease_owner = None
+        # Ids of the feeds items refer to in the feeds table, by feed URL
+        self._feed_ids = {}
+        # Whether messages of new items are stored compressed
+        self._compress = False
         self._connect()
 
     def _connect(self):
@@ -200,21 +885,34 @@ class SpigotDB():
         new_db = False
         if not os.path.exists(self.path):
             new_db = True
-            logging.debug("Database file %s does not exist" % self.path)
+            logging.debug("Database file %s does not exist", self.path)
         det_types = sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
         try:
             self._db = sqlite3.connect(self.path, detect_types=det_types)
         except:
-            logging.exception("Could not connect to database %s" % self.path)
+            logging.exception("Could not connect to database %s", self.path)
             sys.exit(2)
 
         if new_db:
                 self._init_db_tables()
+        elif self.check_old_db():
+            # Keep a copy of the database in case the upgrade goes wrong
+            backup = "%s.bak" % self.path
+            shutil.copyfile(self.path, backup)
+            logging.info("Database backed up to %s before upgrade", backup)
+        try:
+            self.upgrade()
+        except:
+            logging.exception("Could not upgrade database %s", self.path)
+            sys.exit(2)
 
     def _init_db_tables(self):
         """Initialize the database if it is new"""
 
         curs = self._db.cursor()
+        # Allow pruned space to be released without a full VACUUM. This only
+        # takes effect when set before any tables are created.
+        curs.execute("PRAGMA auto_vacuum = INCREMENTAL;")
         # Figure out db tables based on tricklepost
         create_query = """create table items (feed text, link text,
                           message text, title text, date timestamp,
@@ -224,68 +922,883 @@ class SpigotDB():
         logging.debug("Initialized database tables")
         curs.close()
 
-    def check_old_db(self):
-        """Inspect schema of existing sqlite3 database and return True if
-        the database needs to be upgraded to the post 2.2 schema."""
+    def get_schema_version(self):
+        "Return the schema version of the database."
 
         curs = self._db.cursor()
-        curs.execute("PRAGMA table_info(items);")
-        cols = curs.fetchall()
+        curs.execute("PRAGMA user_version;")
+        version = curs.fetchone()[0]
         curs.close()
-        if "message" not in [col[1] for col in cols]:
-            logging.debug("Existing database lacks 'message' field")
-            return True
-        elif "title" not in [col[1] for col in cols]:
-            logging.debug("Existing database lacks 'title' field")
+        return version
+
+    def check_old_db(self):
+        """Return True if the database schema is older than SCHEMA_VERSION
+        and needs to be upgraded."""
+
+        version = self.get_schema_version()
+        if version < self.SCHEMA_VERSION:
+            logging.debug("Existing database has schema version %d", version)
             return True
         else:
             logging.debug("Existing database is up-to-date")
             return False
 
+    def upgrade(self):
+        """Bring the database schema up to SCHEMA_VERSION. Each step runs in
+        its own transaction, so a failed step leaves the database at the
+        previous version."""
+
+        version = self.get_schema_version()
+        compacted = version < 13 <= self.SCHEMA_VERSION
+        # Manage transactions here rather than in the sqlite3 module, which
+        # would otherwise commit before each schema change
+        self._db.isolation_level = None
+        curs = self._db.cursor()
+        try:
+            while version < self.SCHEMA_VERSION:
+                version += 1
+                logging.info("Upgrading database to schema version %d",
+                             version)
+                curs.execute("BEGIN")
+                try:
+                    getattr(self, "_upgrade_to_%d" % version)(curs)
+                    curs.execute("PRAGMA user_version = %d" % version)
+                    curs.execute("COMMIT")
+                except:
+                    curs.execute("ROLLBACK")
+                    raise
+            if compacted:
+                # Release the space of the replaced items table, and let
+                # space freed by pruning be released without a full VACUUM
+                logging.info("Compacting database %s", self.path)
+                curs.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+                curs.execute("VACUUM;")
+        finally:
+            curs.close()
+            self._db.isolation_level = ""
+
+    def _upgrade_to_1(self, curs):
+        """Add the message and title fields introduced in spigot 2.2."""
+
+        curs.execute("PRAGMA table_info(items);")
+        cols = [col[1] for col in curs.fetchall()]
+        for element in ("message", "title"):
+            if element not in cols:
+                curs.execute("ALTER TABLE items ADD COLUMN %s text" % element)
+                logging.info("Added %s column to items", element)
+
+    def _upgrade_to_2(self, curs):
+        """Add the table of per-feed polling state."""
+
+        curs.execute("""create table if not exists feeds (
+                        id integer primary key, url text unique,
+                        etag text, modified text)""")
+
+    def _upgrade_to_3(self, curs):
+        """Index the items table for the lookups made on every run."""
+
+        # Remove any duplicate links so that they can be indexed as unique,
+        # keeping the earliest row and the time the link was posted, if any
+        curs.execute("""UPDATE items SET posted = (SELECT MAX(posted)
+                        FROM items AS dup WHERE dup.link = items.link)
+                        WHERE posted IS NULL AND link IN (SELECT link
+                        FROM items GROUP BY link HAVING COUNT(*) > 1)""")
+        curs.execute("""DELETE FROM items WHERE rowid NOT IN
+                        (SELECT MIN(rowid) FROM items GROUP BY link)""")
+        if curs.rowcount > 0:
+            logging.info("Removed %d duplicate items", curs.rowcount)
+        curs.execute("CREATE UNIQUE INDEX items_link ON items(link)")
+        curs.execute("""CREATE INDEX items_feed_posted
+                        ON items(feed, posted, date)""")
+        self._create_unposted_index(curs, "feed")
+
+    def _upgrade_to_4(self, curs):
+        """Add the table remembering the links of pruned items."""
+
+        curs.execute("create table pruned (hash integer primary key)")
+
+    def _upgrade_to_5(self, curs):
+        """Add the field holding the raw entry of items formatted when they
+        are posted."""
+
+        curs.execute("ALTER TABLE items ADD COLUMN entry text")
+
+    def _upgrade_to_6(self, curs):
+        """Add the link of the newest entry seen in each feed."""
+
+        curs.execute("ALTER TABLE feeds ADD COLUMN newest_link text")
+
+    def _upgrade_to_7(self, curs):
+        """Add the time each feed was last polled."""
+
+        curs.execute("ALTER TABLE feeds ADD COLUMN polled timestamp")
+
+    def _upgrade_to_8(self, curs):
+        """Add the table of feed configuration used by the sqlite config
+        backend. Feed settings other than those with their own column are
+        kept as JSON in options."""
+
+        curs.execute("CREATE TABLE feed_config (url text PRIMARY KEY, \
+            account text, interval integer, format text, title text, \
+            options text, updated timestamp)")
+        curs.execute("CREATE INDEX feed_config_account \
+            ON feed_config (account)")
+
+    def _upgrade_to_9(self, curs):
+        """Add each feed's estimated rate of new items per day and the time
+        of its next poll, used by adaptive polling."""
+
+        curs.execute("ALTER TABLE feeds ADD COLUMN item_rate real")
+        curs.execute("ALTER TABLE feeds ADD COLUMN next_poll timestamp")
+
+    def _upgrade_to_10(self, curs):
+        """Add the leases taken on feeds by workers in multi-worker mode."""
+
+        curs.execute("CREATE TABLE leases (feed text PRIMARY KEY, \
+            owner text, expires timestamp)")
+
+    def _upgrade_to_11(self, curs):
+        """Add the retry state of items which could not be posted: the
+        number of failed attempts, when to try again, the last error and
+        when the item was given up on."""
+
+        curs.execute("ALTER TABLE items ADD COLUMN attempts integer \
+            DEFAULT 0")
+        curs.execute("ALTER TABLE items ADD COLUMN next_attempt timestamp")
+        curs.execute("ALTER TABLE items ADD COLUMN last_error text")
+        curs.execute("ALTER TABLE items ADD COLUMN dead_lettered timestamp")
+
+    def _upgrade_to_12(self, curs):
+        """Add the health of each feed: its number of consecutive failed
+        polls, the last error and when it may next be polled if it keeps
+        failing."""
+
+        curs.execute("ALTER TABLE feeds ADD COLUMN failures integer \
+            DEFAULT 0")
+        curs.execute("ALTER TABLE feeds ADD COLUMN last_error text")
+        curs.execute("ALTER TABLE feeds ADD COLUMN retry_at timestamp")
+
+    def _upgrade_to_13(self, curs):
+        """Rebuild the items table in a compact layout: items refer to their
+        feed by its id in the feeds table, times are whole seconds since the
+        epoch and messages may be stored compressed."""
+
+        curs.execute("INSERT OR IGNORE INTO feeds(url) \
+            SELECT DISTINCT feed FROM items WHERE feed IS NOT NULL")
+        curs.execute("CREATE TABLE items_compact (feed_id integer, \
+            link text, message blob, title text, date integer, \
+            posted integer, entry blob, attempts integer DEFAULT 0, \
+            next_attempt integer, last_error text, dead_lettered integer)")
+        # Convert the times in sqlite, rather than through the converters of
+        # the timestamp columns, which fail on values they cannot parse
+        epoch = "CAST(strftime('%%s', items.%s) AS integer)"
+        curs.execute("INSERT INTO items_compact SELECT feeds.id, \
+            items.link, items.message, items.title, %s, %s, items.entry, \
+            items.attempts, %s, items.last_error, %s FROM items \
+            LEFT JOIN feeds ON feeds.url = items.feed ORDER BY items.rowid"
+                     % tuple(epoch % column for column in
+                             ("date", "posted", "next_attempt",
+                              "dead_lettered")))
+        logging.info("Converted %d items to the compact layout",
+                     curs.rowcount)
+        curs.execute("DROP TABLE items")
+        curs.execute("ALTER TABLE items_compact RENAME TO items")
+        curs.execute("CREATE UNIQUE INDEX items_link ON items(link)")
+        curs.execute("CREATE INDEX items_feed_posted \
+            ON items(feed_id, posted, date)")
+        self._create_unposted_index(curs, "feed_id")
+
+    def _create_unposted_index(self, curs, feed_column):
+        """Index the unposted items of each feed by date. Older versions of
+        sqlite lack partial indexes, and make do with items_feed_posted,
+        which also covers these lookups."""
+
+        if not self.PARTIAL_INDEXES:
+            logging.debug("sqlite %s lacks partial indexes, not creating "
+                          "items_unposted", sqlite3.sqlite_version)
+            return
+        curs.execute("CREATE INDEX items_unposted ON items(%s, date) \
+            WHERE posted IS NULL" % feed_column)
+
+    def enable_wal(self):
+        """Switch the database to write-ahead logging, so that readers in
+        other spigot processes do not block the writer, and wait for locks
+        held by other processes rather than failing at once."""
+
+        curs = self._db.cursor()
+        curs.execute("PRAGMA journal_mode=WAL")
+        curs.execute("PRAGMA busy_timeout=30000")
+        curs.close()
+
+    def enable_compression(self):
+        """Store the messages and raw entries of new items zlib-compressed
+        where that makes them smaller. Compressed values are read back
+        whether or not compression is enabled."""
+
+        self._compress = True
+
+    def _pack_text(self, text):
+        "Return text as it is to be stored, compressed if enabled and smaller."
+
+        if not (self._compress and text):
+            return text
+        data = text
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        packed = zlib.compress(data)
+        if len(packed) < len(data):
+            return sqlite3.Binary(packed)
+        return text
+
+    def _unpack_text(self, value):
+        "Return the text of a value stored by _pack_text."
+
+        if isinstance(value, buffer):
+            return zlib.decompress(value).decode("utf-8")
+        return value
+
+    def _feed_id(self, feed, create=False):
+        """Return the id in the feeds table of the given feed URL, by which
+        items refer to their feed. If create is True a feed not yet in the
+        table is added to it, otherwise None is returned for it."""
+
+        feed_id = self._feed_ids.get(feed)
+        if feed_id is None:
+            curs = self._db.cursor()
+            if create:
+                curs.execute("INSERT OR IGNORE INTO feeds(url) VALUES (?)",
+                             [feed])
+            curs.execute("SELECT id FROM feeds WHERE url=?", [feed])
+            row = curs.fetchone()
+            curs.close()
+            if row:
+                feed_id = self._feed_ids[feed] = row[0]
+        return feed_id
+
+    def acquire_leases(self, feeds, owner, seconds):
+        """Lease each of the given feeds to owner for the given number of
+        seconds, unless another owner holds an unexpired lease on it. Leases
+        already held by owner are renewed. Return the list of feeds owner now
+        holds leases on. All leases are taken in a single transaction."""
+
+        now = datetime.utcnow()
+        expires = now + timedelta(seconds=seconds)
+        leased = []
+        self._lease_owner = owner
+        curs = self._db.cursor()
+        for feed in feeds:
+            curs.execute("INSERT OR IGNORE INTO leases(feed, owner, expires) \
+                VALUES (?, ?, ?)", (feed, owner, expires))
+            if curs.rowcount != 1:
+                curs.execute("UPDATE leases SET owner=?, expires=? \
+                    WHERE feed=? AND (owner=? OR expires<=?)",
+                             (owner, expires, feed, owner, now))
+            if curs.rowcount == 1:
+                leased.append(feed)
+        curs.close()
+        self._db.commit()
+        return leased
+
+    def release_leases(self, owner):
+        "Give up every lease held by owner."
+
+        curs = self._db.cursor()
+        curs.execute("DELETE FROM leases WHERE owner=?", [owner])
+        curs.close()
+        self._db.commit()
+
     def close(self):
         """Cleanup after the db is no longer needed."""
 
+        if self._lease_owner:
+            self.release_leases(self._lease_owner)
+        if self._links_file:
+            self._save_link_cache()
         self._db.close()
         logging.debug("Closed connection to database")
 
+    def enable_link_cache(self, persist=False):
+        """Answer check_link and known_links from an in-memory set of link
+        hashes, which holds the links of every item in the database and every
+        pruned item. If persist is True, the set is kept in a file next to the
+        database between runs and reloaded if the database is unchanged."""
+
+        self._links = None
+        if persist:
+            self._links_file = "%s.links" % self.path
+            self._load_link_cache()
+        if self._links is None:
+            if persist:
+                self._links_marker = self._link_cache_marker()
+            curs = self._db.cursor()
+            curs.execute("SELECT link FROM items")
+            self._links = set([link_hash(row[0]) for row in curs
+                               if row[0] is not None])
+            curs.execute("SELECT hash FROM pruned")
+            self._links.update([row[0] for row in curs])
+            curs.close()
+            logging.debug("Loaded %d links into link cache from database",
+                          len(self._links))
+
+    def _link_cache_marker(self):
+        """Return a value which changes when items are added to the database,
+        used to tell whether a saved link cache is still current."""
+
+        curs = self._db.cursor()
+        curs.execute("SELECT MAX(rowid) FROM items")
+        max_rowid = curs.fetchone()[0] or 0
+        curs.execute("SELECT COUNT(*) FROM pruned")
+        num_pruned = curs.fetchone()[0]
+        # Changes when another connection commits to the database
+        curs.execute("PRAGMA data_version;")
+        row = curs.fetchone()
+        self._data_version = row and row[0]
+        curs.close()
+        return (max_rowid, num_pruned)
+
+    def _load_link_cache(self):
+        """Load the link cache file if it matches the database."""
+
+        try:
+            data = open(self._links_file, "rb").read()
+        except IOError:
+            return
+        header = struct.calcsize("<qqq")
+        max_rowid, num_pruned, num_links = struct.unpack("<qqq",
+                                                         data[:header])
+        if (max_rowid, num_pruned) != self._link_cache_marker():
+            logging.debug("Link cache file %s is out of date",
+                          self._links_file)
+            return
+        self._links_marker = (max_rowid, num_pruned)
+        self._links = set(struct.unpack("<%dq" % num_links, data[header:]))
+        logging.debug("Loaded %d links into link cache from %s",
+                      num_links, self._links_file)
+
+    def _save_link_cache(self):
+        """Write the link cache to its file, tagged with the state of the
+        database it matches. Other processes, such as other workers, may have
+        added or pruned items which are not in the cache, in which case it is
+        tagged with the state it was built or loaded from, so that it is
+        found out of date when next loaded."""
+
+        data_version = self._data_version
+        max_rowid, num_pruned = self._link_cache_marker()
+        if data_version is None or data_version != self._data_version:
+            max_rowid, num_pruned = self._links_marker
+        header = struct.pack("<qqq", max_rowid, num_pruned, len(self._links))
+        # Replace the file atomically, as other processes may be reading it
+        tmp_file = "%s.tmp" % self._links_file
+        try:
+            cache_file = open(tmp_file, "wb")
+            cache_file.write(header)
+            cache_file.write(struct.pack("<%dq" % len(self._links),
+                                         *self._links))
+            cache_file.close()
+            os.rename(tmp_file, self._links_file)
+            logging.debug("Saved link cache to %s", self._links_file)
+        except (IOError, OSError):
+            logging.warning("Could not save link cache %s", self._links_file)
+
     def check_link(self, item_link):
         """Returns true if the specified link is already in the database."""
 
+        if self._links is not None:
+            return link_hash(item_link) in self._links
         curs = self._db.cursor()
-        curs.execute("select * from items where link=?", [item_link])
-        items = curs.fetchall()
-        if len(items) > 0:
+        curs.execute("select 1 from items where link=?", [item_link])
+        found = curs.fetchone()
+        if not found:
+            # Items pruned from the database must not be added again
+            curs.execute("select 1 from pruned where hash=?",
+                         [link_hash(item_link)])
+            found = curs.fetchone()
+        curs.close()
+        if found:
             return True
         else:
             return False
-        curs.close()
 
     def add_item(self, feed_url, link, message, title, date):
         """Add an item to the database with the given parameters. Return True
         if successful."""
 
+        feed_id = self._feed_id(feed_url, create=True)
         curs = self._db.cursor()
-        curs.execute("insert into items(feed, link, message, title, date) \
-            values (?, ?, ?, ?, ?)", (feed_url, link, message, title, date))
-        logging.debug("    Added item %s to database" % link)
+        curs.execute("insert into items(feed_id, link, message, title, date) \
+            values (?, ?, ?, ?, ?)", (feed_id, link, self._pack_text(message),
+                                      title, to_epoch(date)))
+        logging.debug("    Added item %s to database", link)
         curs.close()
+        if self._links is not None:
+            self._links.add(link_hash(link))
 
         self._db.commit()
         return True
 
+    def add_items(self, feed_url, items, commit=True):
+        """Add the items from the given feed which are not already in the
+        database. Each item is a tuple of (link, message, title, date), with
+        an optional fifth element holding the item's fields as saved by
+        SpigotFeeds.get_fields for formatting when it is posted. The whole
+        batch is checked against the database at once and committed in
+        a single transaction, unless commit is False. Return the number of
+        items added."""
+
+        # Drop duplicates within the batch, keeping the first occurrence
+        feed_id = self._feed_id(feed_url, create=True)
+        batch = []
+        links = set()
+        for item in items:
+            link, message, title, date = item[:4]
+            entry = None
+            if len(item) > 4:
+                entry = item[4]
+            if link not in links:
+                links.add(link)
+                batch.append((feed_id, link, self._pack_text(message),
+                              title, to_epoch(date), self._pack_text(entry)))
+        if not batch:
+            return 0
+        known = self.known_links(links)
+        new_items = [item for item in batch if item[1] not in known]
+        curs = self._db.cursor()
+        curs.executemany("insert or ignore into items(feed_id, link, \
+            message, title, date, entry) values (?, ?, ?, ?, ?, ?)",
+                         new_items)
+        logging.debug("    Added %d of %d items to database",
+                      len(new_items), len(batch))
+        curs.close()
+        if self._links is not None:
+            self._links.update([link_hash(item[1]) for item in new_items])
+
+        if commit:
+            self._db.commit()
+        return len(new_items)
+
+    def known_links(self, links):
+        "Return the set of the given links which are already in the database."
+
+        if self._links is not None:
+            return set([link for link in links
+                        if link_hash(link) in self._links])
+        links = list(links)
+        known = set()
+        curs = self._db.cursor()
+        # Stay well below SQLite's limit on the number of query parameters
+        for start in range(0, len(links), 500):
+            chunk = links[start:start + 500]
+            marks = ", ".join(["?"] * len(chunk))
+            curs.execute("select link from items where link in (%s)" % marks,
+                         chunk)
+            known.update([row[0] for row in curs.fetchall()])
+            # Items pruned from the database must not be added again
+            hashes = dict([(link_hash(link), link) for link in chunk
+                           if link not in known])
+            if hashes:
+                marks = ", ".join(["?"] * len(hashes))
+                curs.execute("select hash from pruned where hash in (%s)"
+                             % marks, hashes.keys())
+                known.update([hashes[row[0]] for row in curs.fetchall()])
+        curs.close()
+        return known
+
+    def commit(self):
+        "Commit pending changes, such as from add_items(commit=False)."
+
+        self._db.commit()
+
+    def rollback(self):
+        "Discard pending changes, such as those of a failed update."
+
+        self._db.rollback()
+        # Ids of feeds added in the discarded transaction may be reused
+        self._feed_ids = {}
+        # The link cache may hold links of items which were not committed
+        if self._links is not None:
+            self.enable_link_cache(persist=self._links_file is not None)
+
+    def prune(self, max_age=None, per_feed=None):
+        """Delete posted items older than the timedelta max_age, and all but
+        the latest per_feed posted items of each feed. The latest posted item
+        of each feed is always kept, as posting intervals are measured from
+        it. The links of deleted items are remembered as hashes so that they
+        are not added again. Return the number of items deleted."""
+
+        if not (max_age or per_feed):
+            return 0
+        latest = "rowid NOT IN (SELECT rowid FROM items WHERE \
+            (feed_id=? AND posted is not NULL) ORDER BY posted DESC LIMIT ?)"
+        conditions = []
+        if max_age:
+            conditions.append("posted < ?")
+        if per_feed:
+            conditions.append(latest)
+        query = "SELECT rowid, link FROM items WHERE \
+            (feed_id=? AND posted is not NULL) AND (%s) AND %s" \
+            % (" OR ".join(conditions), latest)
+
+        curs = self._db.cursor()
+        curs.execute("SELECT DISTINCT feed_id FROM items")
+        feeds = [row[0] for row in curs.fetchall()]
+        doomed = []
+        for feed in feeds:
+            params = [feed]
+            if max_age:
+                params.append(to_epoch(datetime.utcnow() - max_age))
+            if per_feed:
+                params.extend([feed, int(per_feed)])
+            params.extend([feed, 1])
+            curs.execute(query, params)
+            doomed.extend(curs.fetchall())
+        curs.executemany("INSERT OR IGNORE INTO pruned(hash) VALUES (?)",
+                         [(link_hash(link),) for rowid, link in doomed])
+        curs.executemany("DELETE FROM items WHERE rowid=?",
+                         [(rowid,) for rowid, link in doomed])
+        self._db.commit()
+        logging.info("Pruned %d posted items from database", len(doomed))
+
+        # Hand the freed pages back to the filesystem
+        curs.execute("PRAGMA auto_vacuum;")
+        if curs.fetchone()[0] != 2:
+            # Databases created before pruning existed need one full VACUUM
+            # before incremental vacuuming takes effect
+            logging.info("Enabling incremental vacuum on database")
+            curs.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+            curs.execute("VACUUM;")
+        else:
+            curs.execute("PRAGMA incremental_vacuum;")
+            curs.fetchall()
+        curs.close()
+        return len(doomed)
+
+    def get_feed_configs(self, account=None):
+        """Return a dict of the configuration of each feed stored in the
+        database, or only of the feeds posting to the given account, keyed on
+        feed URL."""
+
+        query = "SELECT url, account, interval, format, title, options \
+            FROM feed_config"
+        params = []
+        if account is not None:
+            query += " WHERE account=?"
+            params.append(account)
+        curs = self._db.cursor()
+        curs.execute(query, params)
+        feeds = {}
+        for url, account, interval, form, title, options in curs:
+            feed = {}
+            if options:
+                feed.update(json.loads(options))
+            feed.update({"account": account, "interval": interval,
+                         "format": form, "title": title})
+            feeds[url] = feed
+        curs.close()
+        return feeds
+
+    def set_feed_configs(self, feeds):
+        """Add or replace the configuration of each feed in the given dict,
+        keyed on feed URL, in a single transaction."""
+
+        now = datetime.utcnow()
+        rows = []
+        for url, feed in feeds.items():
+            options = dict((key, value) for key, value in feed.items()
+                           if key not in ("account", "interval", "format",
+                                          "title"))
+            rows.append((url, feed["account"], feed["interval"],
+                         feed["format"], feed.get("title", ""),
+                         json.dumps(options) if options else None, now))
+        curs = self._db.cursor()
+        curs.executemany("INSERT OR REPLACE INTO feed_config(url, account, \
+            interval, format, title, options, updated) \
+            VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        curs.close()
+        self._db.commit()
+        logging.debug("Stored configuration of %d feeds", len(rows))
+
+    def delete_feed_config(self, url):
+        "Remove the configuration of the given feed."
+
+        curs = self._db.cursor()
+        curs.execute("DELETE FROM feed_config WHERE url=?", [url])
+        curs.close()
+        self._db.commit()
+
+    def get_feed_config_stamp(self):
+        """Return a value which changes whenever a feed's configuration is
+        added, replaced or removed."""
+
+        curs = self._db.cursor()
+        curs.execute("SELECT COUNT(*), MAX(updated) FROM feed_config")
+        stamp = curs.fetchone()
+        curs.close()
+        return stamp
+
+    def get_feed_cache(self, feed):
+        """Return a tuple of the (etag, modified) values sent by the server
+        when the given feed was last fetched, or (None, None)."""
+
+        curs = self._db.cursor()
+        curs.execute("SELECT etag, modified FROM feeds WHERE url=?", [feed])
+        result = curs.fetchone()
+        curs.close()
+        if result:
+            return result
+        else:
+            return (None, None)
+
+    def set_feed_cache(self, feed, etag, modified, commit=True):
+        """Store the etag and modified values sent by the server for the
+        given feed, to be sent back when it is next fetched. The change is
+        left uncommitted if commit is False."""
+
+        curs = self._db.cursor()
+        curs.execute("INSERT OR IGNORE INTO feeds(url) VALUES (?)", [feed])
+        curs.execute("UPDATE feeds SET etag=?, modified=? WHERE url=?",
+                     (etag, modified, feed))
+        logging.debug("  Updated cache headers of feed %s in database", feed)
+        curs.close()
+        if commit:
+            self._db.commit()
+
+    def get_poll_times(self):
+        """Return a dict of the datetime each feed was last polled, keyed on
+        feed URL."""
+
+        curs = self._db.cursor()
+        curs.execute("SELECT url, polled FROM feeds WHERE polled IS NOT NULL")
+        poll_times = dict(curs.fetchall())
+        curs.close()
+        return poll_times
+
+    def set_poll_time(self, feed, polled, next_poll=None, item_rate=None,
+                      commit=True):
+        """Record that the given feed was polled at the datetime polled,
+        along with the datetime it is next due to be polled and its estimated
+        rate of new items per day if polling is adaptive. The change is left
+        uncommitted if commit is False."""
+
+        curs = self._db.cursor()
+        curs.execute("INSERT OR IGNORE INTO feeds(url) VALUES (?)", [feed])
+        curs.execute("UPDATE feeds SET polled=?, next_poll=?, item_rate=? \
+            WHERE url=?", (polled, next_poll, item_rate, feed))
+        curs.close()
+        if commit:
+            self._db.commit()
+
+    def get_poll_state(self, feed):
+        """Return a tuple of the datetime the given feed was last polled and
+        its estimated rate of new items per day, or (None, None)."""
+
+        curs = self._db.cursor()
+        curs.execute("SELECT polled, item_rate FROM feeds WHERE url=?",
+                     [feed])
+        result = curs.fetchone()
+        curs.close()
+        if result:
+            return result
+        else:
+            return (None, None)
+
+    def get_next_polls(self):
+        """Return a dict of the datetime each feed is next due to be polled
+        under adaptive polling, keyed on feed URL."""
+
+        curs = self._db.cursor()
+        curs.execute("SELECT url, next_poll FROM feeds \
+            WHERE next_poll IS NOT NULL")
+        next_polls = dict(curs.fetchall())
+        curs.close()
+        return next_polls
+
+    def record_feed_failure(self, feed, error, threshold, delay, max_delay):
+        """Record a failed poll of the given feed. Once it has failed
+        threshold times in a row it is not polled again for delay minutes,
+        doubling with each further failure up to max_delay. Return the
+        number of consecutive failures and the datetime of the next retry, or
+        None if the feed may be polled as usual."""
+
+        curs = self._db.cursor()
+        curs.execute("INSERT OR IGNORE INTO feeds(url) VALUES (?)", [feed])
+        curs.execute("SELECT failures FROM feeds WHERE url=?", [feed])
+        failures = (curs.fetchone()[0] or 0) + 1
+        retry_at = None
+        if failures >= threshold:
+            wait = min(delay * 2 ** (failures - threshold), max_delay)
+            retry_at = datetime.utcnow() + timedelta(minutes=wait)
+        curs.execute("UPDATE feeds SET failures=?, last_error=?, retry_at=? \
+            WHERE url=?", (failures, error, retry_at, feed))
+        curs.close()
+        self._db.commit()
+        return failures, retry_at
+
+    def clear_feed_failures(self, feed, commit=True):
+        """Record that the given feed was polled successfully. The change is
+        left uncommitted if commit is False."""
+
+        curs = self._db.cursor()
+        curs.execute("UPDATE feeds SET failures=0, last_error=NULL, \
+            retry_at=NULL WHERE url=? AND failures > 0", [feed])
+        if curs.rowcount and commit:
+            self._db.commit()
+        curs.close()
+
+    def get_retry_times(self):
+        """Return a dict of the datetime before which each failing feed is
+        not to be polled, keyed on feed URL."""
+
+        curs = self._db.cursor()
+        curs.execute("SELECT url, retry_at FROM feeds \
+            WHERE retry_at IS NOT NULL")
+        retry_times = dict(curs.fetchall())
+        curs.close()
+        return retry_times
+
+    def get_feed_health(self):
+        """Return a dict of (polled, failures, last_error, retry_at) tuples
+        giving the health of each feed, keyed on feed URL."""
+
+        curs = self._db.cursor()
+        curs.execute("SELECT url, polled, failures, last_error, retry_at \
+            FROM feeds")
+        health = dict((row[0], row[1:]) for row in curs.fetchall())
+        curs.close()
+        return health
+
+    def get_newest_link(self, feed):
+        """Return the link of the newest entry seen when the given feed was
+        last scanned, or None."""
+
+        curs = self._db.cursor()
+        curs.execute("SELECT newest_link FROM feeds WHERE url=?", [feed])
+        result = curs.fetchone()
+        curs.close()
+        if result:
+            return result[0]
+        else:
+            return None
+
+    def set_newest_link(self, feed, link, commit=True):
+        """Store the link of the newest entry seen in the given feed. The
+        change is left uncommitted if commit is False."""
+
+        curs = self._db.cursor()
+        curs.execute("INSERT OR IGNORE INTO feeds(url) VALUES (?)", [feed])
+        curs.execute("UPDATE feeds SET newest_link=? WHERE url=?",
+                     (link, feed))
+        curs.close()
+        if commit:
+            self._db.commit()
+
     def get_unposted_items(self, feed):
-        "Return a list of items in the database which have yet to be posted."
+        """Return a list of items in the database which have yet to be posted,
+        leaving out items waiting to be retried and those given up on."""
 
         curs = self._db.cursor()
-        curs.execute("SELECT feed, link, message, title FROM items \
-            where (posted is NULL AND feed=?) \
-            ORDER BY date ASC", [feed])
-        unposted_items = curs.fetchall()
+        curs.execute("SELECT link, message, title FROM items \
+            where (posted is NULL AND feed_id=?) AND dead_lettered IS NULL \
+            AND (next_attempt IS NULL OR next_attempt <= ?) \
+            ORDER BY date ASC", (self._feed_id(feed),
+                                 to_epoch(datetime.utcnow())))
+        unposted_items = [(feed, link, self._unpack_text(message), title)
+                          for link, message, title in curs.fetchall()]
         num_items = len(unposted_items)
-        logging.debug("  Found %d unposted items in %s" % (num_items, feed))
+        logging.debug("  Found %d unposted items in %s", num_items, feed)
         curs.close()
         return unposted_items
 
+    def get_next_items(self, feed=None):
+        """Return a list of (feed, link, message, title, entry, latest) tuples
+        giving the oldest unposted item of each feed, or only of the given
+        feed, along with the datetime of the feed's latest post or None.
+        Items given up on are skipped, while a feed whose oldest item is
+        waiting to be retried is left out until it is due."""
+
+        query = "SELECT u.feed_id AS feed_id, u.link AS link, \
+            u.message AS message, u.title AS title, u.entry AS entry, \
+            MIN(u.date), \
+            (SELECT MAX(posted) FROM items AS p WHERE p.feed_id = u.feed_id) \
+            AS latest, u.next_attempt AS next_attempt FROM items AS u \
+            WHERE u.posted is NULL AND u.dead_lettered IS NULL"
+        params = []
+        if feed is not None:
+            feed_id = self._feed_id(feed)
+            if feed_id is None:
+                return []
+            query += " AND u.feed_id=?"
+            params.append(feed_id)
+        # sqlite takes the other columns from the row matching MIN(date)
+        query += " GROUP BY u.feed_id"
+        query = "SELECT feeds.url, link, message, title, entry, latest \
+            FROM (%s) JOIN feeds ON feeds.id = feed_id \
+            WHERE next_attempt IS NULL OR next_attempt <= ?" % query
+        params.append(to_epoch(datetime.utcnow()))
+        curs = self._db.cursor()
+        curs.execute(query, params)
+        next_items = [(url, link, self._unpack_text(message), title,
+                       self._unpack_text(entry), from_epoch(latest))
+                      for url, link, message, title, entry, latest
+                      in curs.fetchall()]
+        curs.close()
+        return next_items
+
+    def has_unposted_items(self, feed):
+        "Return True if the given feed has items which have yet to be posted."
+
+        curs = self._db.cursor()
+        curs.execute("SELECT 1 FROM items \
+            where (posted is NULL AND feed_id=?) AND dead_lettered IS NULL \
+            LIMIT 1", [self._feed_id(feed)])
+        result = curs.fetchone()
+        curs.close()
+        if result:
+            return True
+        else:
+            return False
+
+    def mark_posted_items(self, items):
+        """Mark each of the given (link, date) items posted at its datetime,
+        committing them all at once."""
+
+        curs = self._db.cursor()
+        curs.executemany("UPDATE items SET posted=? WHERE link=?",
+                         [(to_epoch(date), link) for link, date in items])
+        logging.debug("  Updated posted time of %d items in database",
+                      len(items))
+        curs.close()
+        self._db.commit()
+
+    def mark_failed_items(self, items, delay, max_delay, limit=None):
+        """Record a failed attempt to post each of the given (link, error)
+        items, committing them all at once. The next attempt is put off for
+        delay minutes, doubling with each further failure up to max_delay,
+        while an item which has failed limit times is given up on instead.
+        Return the links of the items given up on."""
+
+        now = to_epoch(datetime.utcnow())
+        dead = []
+        curs = self._db.cursor()
+        for link, error in items:
+            curs.execute("SELECT attempts FROM items WHERE link=?", [link])
+            row = curs.fetchone()
+            attempts = (row and row[0] or 0) + 1
+            if limit and attempts >= limit:
+                curs.execute("UPDATE items SET attempts=?, last_error=?, \
+                    next_attempt=NULL, dead_lettered=? WHERE link=?",
+                             (attempts, error, now, link))
+                dead.append(link)
+                continue
+            wait = min(delay * 2 ** (attempts - 1), max_delay)
+            curs.execute("UPDATE items SET attempts=?, last_error=?, \
+                next_attempt=? WHERE link=?",
+                         (attempts, error, now + wait * 60, link))
+        logging.debug("  Recorded failed attempts of %d items in database",
+                      len(items))
+        curs.close()
+        self._db.commit()
+        return dead
+
     def mark_posted(self, item_link, date=None):
         """Mark the given item posted by setting its posted datetime to now."""
 
@@ -293,9 +1806,9 @@ class SpigotDB():
             date = datetime.utcnow()
         curs = self._db.cursor()
         curs.execute("UPDATE items SET posted=? WHERE link=?",
-                     (date, item_link))
-        logging.debug("  Updated posted time of item %s in database"
-                      % item_link)
+                     (to_epoch(date), item_link))
+        logging.debug("  Updated posted time of item %s in database",
+                      item_link)
         curs.close()
         self._db.commit()
 
@@ -305,128 +1818,788 @@ class SpigotDB():
 
         curs = self._db.cursor()
         curs.execute("SELECT posted FROM items WHERE \
-            (feed=? AND posted is not NULL) ORDER BY posted DESC LIMIT 1",
-                     [feed])
+            (feed_id=? AND posted is not NULL) ORDER BY posted DESC LIMIT 1",
+                     [self._feed_id(feed)])
         result = curs.fetchone()
         curs.close()
         if result:
-            logging.debug("  Latest post for feed %s is %s" % (feed,
-                                                               result[0]))
-            return result[0]
+            latest = from_epoch(result[0])
+            logging.debug("  Latest post for feed %s is %s", feed, latest)
+            return latest
         else:
-            logging.debug("  No items from feed %s have been posted" % feed)
+            logging.debug("  No items from feed %s have been posted", feed)
             return None
 
 
+class SpigotFetcher():
+    """Download feeds over pooled keep-alive HTTP connections, so that feeds
+    on the same server share connections, and hand them to feedparser.
+    """
+
+    # Response headers passed on to feedparser. The body is decompressed by
+    # requests, so the content-encoding header must not be passed.
+    passed_headers = ("content-type", "content-location", "content-language",
+                      "etag", "last-modified")
+
+    def __init__(self, pool_size=10, host_limit=4):
+        self._session = requests.Session()
+        self._session.headers["User-Agent"] = "Spigot/%s" % SPIGOT_VERSION
+        # Block rather than open more than host_limit connections to a host
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                pool_maxsize=host_limit,
+                                                pool_block=True)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+    def fetch(self, url, etag=None, modified=None, timeout=None):
+        """Download and parse the feed at the given URL, sending the etag and
+        modified values of a previous fetch to make the request conditional.
+        Return the parsed feed, with a status of 304 if it has not changed.
+        The whole download must finish within timeout seconds."""
+
+        with metrics.timer("fetch", url):
+            deadline = timeout and time() + timeout
+            response = self.open(url, etag, modified, timeout, stream=True)
+            if response.status_code == 304:
+                response.close()
+                return feedparser.FeedParserDict(status=304,
+                                                 href=response.url,
+                                                 entries=[], etag=etag,
+                                                 modified=modified)
+            content = self.read(response, deadline)
+        response_headers = dict([(name, value) for name, value
+                                 in response.headers.items()
+                                 if name.lower() in self.passed_headers])
+        with metrics.timer("parse", url):
+            p = feedparser.parse(content, response_headers=response_headers)
+        p["status"] = response.status_code
+        p["href"] = response.url
+        return p
+
+    def open(self, url, etag=None, modified=None, timeout=None,
+             stream=False):
+        """Send a request for the given URL, conditional on the etag and
+        modified values of a previous fetch, and return the response. With
+        stream, the body is left to be read from the response's raw attribute
+        with decoding enabled."""
+
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if modified:
+            headers["If-Modified-Since"] = modified
+        response = self._session.get(url, headers=headers, timeout=timeout,
+                                     stream=stream)
+        if stream:
+            response.raw.decode_content = True
+        return response
+
+    def read(self, response, deadline=None):
+        """Return the decoded body of the streamed response, raising a
+        Timeout if it is still being downloaded after the time deadline.
+        The timeout of the request itself only bounds each read, which a
+        server sending the body a little at a time never exceeds."""
+
+        chunks = []
+        try:
+            for chunk in response.iter_content(16384):
+                chunks.append(chunk)
+                if deadline and time() > deadline:
+                    raise requests.exceptions.Timeout(
+                        "Download of %s took too long" % response.url)
+        finally:
+            response.close()
+        return "".join(chunks)
+
+
 class SpigotFeeds():
     """
     Handle the polling the specified feeds for new posts. Add new posts to
     database in preparation for posting to the specified Pump.io accounts.
     """
 
+    # Fields of each entry stored with render_at_post, in addition to those
+    # used by the feed's formats, so that format changes can use them
+    stored_fields = ("id", "link", "title", "summary", "content", "author",
+                     "published", "updated")
+    # Number of entries of a streamed feed held in memory at once
+    stream_chunk = 100
+
     def __init__(self, db, config):
         self._spigotdb = db
         self._config = config
+        # Compiled message formats keyed on the format string
+        self._templates = {}
+        self._templates_generation = None
+        self._fetcher = None
+        self._fetcher_lock = threading.Lock()
+        # Start of the current poll_feeds, recorded as each feed's poll time
+        self._poll_time = None
+
+    def get_fetcher(self):
+        """Return the SpigotFetcher shared by all polls of this instance,
+        creating it on first use."""
+
+        self._fetcher_lock.acquire()
+        try:
+            if self._fetcher is None:
+                self._fetcher = SpigotFetcher(
+                    self._config.get_setting("http_pool_size"),
+                    self._config.get_setting("http_host_limit"))
+            return self._fetcher
+        finally:
+            self._fetcher_lock.release()
+
+    def get_template(self, feed, element):
+        """Return the compiled form of the given feed's configured format
+        element, compiling it on first use after each configuration load."""
+
+        if self._templates_generation != self._config.generation:
+            self._templates = {}
+            self._templates_generation = self._config.generation
+        form = self._config["feeds"][feed][element]
+        try:
+            return self._templates[form]
+        except KeyError:
+            template = compile_format(form)
+            self._templates[form] = template
+            return template
+
+    def _field_value(self, entry, field):
+        "Return the value of the given field of a feed entry, or ''."
+
+        if field in entry:
+            # Make a special exception for the content element, which in
+            # ATOM can appear multiple times per entry. Assume the element
+            # with index=0 is the desired value.
+            if field == "content":
+                return entry.content[0].value
+            else:
+                return entry[field]
+        else:
+            return ""
 
     def format_element(self, feed, entry, element):
         """Returns an outgoing message for the given entry based on the given
         feed's configured format."""
 
-        message = self._config["feeds"][feed][element]
-        # Store a list of tuples containing format string and value
-        replaces = []
-        field_re = re.compile("%\w+%")
-        fields = field_re.findall(message)
-        for raw_field in fields:
-            # Trim the % character from format
-            field = raw_field[1:-1]
+        parts = list(self.get_template(feed, element))
+        # Fill in the fields, found at every odd index, with actual values
+        for i in range(1, len(parts), 2):
+            parts[i] = self._field_value(entry, parts[i])
+        return "".join(parts)
+
+    def format_fields(self, feed):
+        "Return the names of the fields used in the given feed's formats."
+
+        return (self.get_template(feed, "format")[1::2] +
+                self.get_template(feed, "title")[1::2])
+
+    def read_fields(self, feed):
+        """Return the names of the fields of the given feed's entries which
+        are needed to format them, now or when they are posted."""
+
+        fields = self.format_fields(feed)
+        if self._config.get_setting("render_at_post"):
+            fields = fields + list(self.stored_fields)
+        return fields
+
+    def get_fields(self, feed, entry):
+        """Return a dict of the values of the entry's stored_fields and the
+        fields used in the given feed's message and title formats, leaving
+        out those the entry does not have."""
+
+        fields = {}
+        for field in self.stored_fields + tuple(self.format_fields(feed)):
             if field in entry:
-                # Make a special exception for the content element, which in
-                # ATOM can appear multiple times per entry. Assume the element
-                # with index=0 is the desired value.
-                if field == "content":
-                    logging.debug("    'content' field in formatting string")
-                    value = entry.content[0].value
-                else:
-                    value = entry[field]
+                fields[field] = self._field_value(entry, field)
+        return fields
+
+    def render(self, feed, fields, element):
+        """Returns an outgoing message based on the given feed's configured
+        format from a dict of field values saved by get_fields."""
+
+        parts = list(self.get_template(feed, element))
+        for i in range(1, len(parts), 2):
+            field = parts[i]
+            if field not in fields and field not in self.stored_fields:
+                # The format has changed to use a field which was not stored
+                logging.warning("Field %s of feed %s was not stored with the "
+                                "item, leaving it empty", field, feed)
+            parts[i] = fields.get(field, "")
+        return "".join(parts)
+
+    def poll_feeds(self, urls=None):
+        """Check the given feeds, or all configured feeds which are due to be
+        polled, for new posts.
+
+        Feeds are fetched by a pool of poll_workers threads, while all
+        database updates are made from the calling thread."""
+
+        if urls is None:
+            urls = self.due_polls()
+        self._poll_time = datetime.utcnow()
+        workers = int(self._config.get_setting("poll_workers"))
+        timeout = self._config.get_setting("poll_timeout")
+        # feedparser offers no timeout of its own, so bound each socket
+        # operation for the duration of the poll
+        old_timeout = socket.getdefaulttimeout()
+        socket.setdefaulttimeout(timeout)
+        try:
+            if workers > 1 and len(urls) > 1:
+                self._poll_concurrent(urls, workers, timeout)
             else:
-                value = ""
-            replaces.append((raw_field, value))
-        # Fill in the message format with actual values
-        for string, val in replaces:
-            message = message.replace(string, val)
-        return message
+                for url in urls:
+                    self.scan_feed(url)
+        finally:
+            socket.setdefaulttimeout(old_timeout)
+
+    def _poll_concurrent(self, urls, workers, timeout):
+        """Fetch the given feeds using a pool of worker threads and process
+        each result as it arrives. Each fetch gives up on its own feed once
+        it has taken timeout seconds. A fetch which still has not returned
+        long after that, as can happen outside of HTTP, is counted as a
+        failure of its feed and its worker replaced, so that the feeds still
+        queued are fetched."""
+
+        pending = Queue.Queue()
+        results = Queue.Queue()
+        # Time at which each feed's fetch started, set by the workers
+        started = {}
+        # Look up feed state here, as workers must not use the database
+        for url in urls:
+            etag, modified = self._spigotdb.get_feed_cache(url)
+            pending.put((url, etag, modified, self._stop_link(url)))
+
+        def worker():
+            while True:
+                try:
+                    url, etag, modified, stop_link = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                started[url] = time()
+                p = self.fetch_feed(url, etag, modified, stop_link)
+                if isinstance(p.entries, list):
+                    results.put((url, p))
+                    continue
+                # Parse streamed feeds here, handing their entries to the
+                # calling thread a chunk at a time
+                chunks = Queue.Queue(2)
+                done = threading.Event()
+                entries = p.entries
+                p["entries"] = self._take_chunks(chunks, done, timeout)
+                results.put((url, p))
+                self._hand_over_chunks(entries, chunks, done)
+
+        def start_worker(name):
+            thread = threading.Thread(target=worker, name=name)
+            # Do not let a hung fetch keep the process alive
+            thread.daemon = True
+            thread.start()
+
+        workers = min(workers, len(urls))
+        logging.debug("Polling %d feeds with %d workers", len(urls),
+                      workers)
+        for i in range(workers):
+            start_worker("poll-%d" % i)
+
+        waiting = set(urls)
+        while waiting:
+            try:
+                url, p = results.get(timeout=timeout)
+            except Queue.Empty:
+                now = time()
+                hung = [url for url in waiting if url in started and
+                        now - started[url] > timeout * 2]
+                for url in hung:
+                    waiting.discard(url)
+                    self.record_failure(url, "Timed out")
+                    start_worker("poll-%s" % url)
+                continue
+            if url in waiting:
+                # Results of fetches already counted as hung are dropped
+                waiting.discard(url)
+                self.handle_feed(url, p)
+
+    def _hand_over_chunks(self, entries, chunks, done):
+        """Put chunks of the given entries in the queue chunks, followed by
+        None, or the exception raised while reading them, until done is set
+        by the thread taking them."""
+
+        def put(value):
+            while not done.is_set():
+                try:
+                    chunks.put(value, timeout=1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
 
-    def poll_feeds(self):
-        """Check the configured feeds for new posts."""
+        try:
+            for chunk in iter_chunks(entries, self.stream_chunk):
+                if not put(chunk):
+                    entries.close()
+                    return
+        except Exception, e:
+            put(e)
+            return
+        put(None)
+
+    def _take_chunks(self, chunks, done, timeout):
+        """Generate the entries handed over by _hand_over_chunks, raising a
+        Timeout if the next chunk takes more than twice timeout seconds."""
 
-        feeds_to_poll = self._config.get_feeds()
-        for url, account, interval, form in feeds_to_poll:
-            self.scan_feed(url)
+        try:
+            while True:
+                try:
+                    chunk = chunks.get(timeout=timeout * 2)
+                except Queue.Empty:
+                    raise requests.exceptions.Timeout("Timed out reading feed")
+                if chunk is None:
+                    return
+                if isinstance(chunk, Exception):
+                    raise chunk
+                for entry in chunk:
+                    yield entry
+        finally:
+            done.set()
+
+    def _stop_link(self, url):
+        """Return the link at which a streaming parse of the given feed may
+        stop, or None if it must be read in full."""
+
+        if (self._config.get_setting("streaming_parse") and
+                self._config.get_setting("incremental_scan")):
+            return self._spigotdb.get_newest_link(url)
+        else:
+            return None
 
-    def scan_feed(self, url):
-        """Poll the given feed and then update the database with new info"""
+    def fetch_feed(self, url, etag=None, modified=None, stop_link=None):
+        """Download and parse the given feed, returning the result, which is
+        bozo with no entries if the feed could not be fetched. The etag and
+        modified values from a previous fetch make the request conditional.
+        Does not touch the database, so it is safe to call from a worker
+        thread."""
 
-        logging.debug("Polling feed %s for new items" % url)
+        logging.debug("Polling feed %s for new items", url)
         # Allow for parsing of this feed to fail without raising an exception
         try:
-            p = feedparser.parse(url)
-        except:
-            logging.error("Unable to parse feed %s" % url)
-            return None
-        # Get a list of items for the feed and compare it to the database
-        num_items = len(p.entries)
-        logging.debug("Found %d items in feed %s" % (num_items, url))
-        new_items = 0
-        for i in range(len(p.entries)):
-            logging.debug("  Processing item %d" % i)
-            title = p.entries[i].title
-            logging.debug("    Title: %s" % title)
-            link = p.entries[i].link
-            logging.debug("    Link: %s" % link)
-            # Check for existence of published_parsed, fail back to updated
-            if 'published_parsed' in p.entries[i]:
-                date = p.entries[i].published_parsed
+            if self._config.get_setting("streaming_parse"):
+                return self.stream_feed(url, etag, modified, stop_link)
             else:
-                date = p.entries[i].updated_parsed
-            date_struct = datetime.fromtimestamp(mktime(date))
-            logging.debug("    Date: %s" % datetime.isoformat(date_struct))
+                return self.parse_feed(url, etag, modified)
+        except Exception, e:
+            logging.error("Unable to parse feed %s", url)
+            metrics.incr("fetch_errors", url)
+            return feedparser.FeedParserDict(entries=[], bozo=1,
+                                             bozo_exception=e)
+
+    def parse_feed(self, url, etag=None, modified=None):
+        "Download and parse the whole of the given feed with feedparser."
+
+        if url.startswith("http://") or url.startswith("https://"):
+            timeout = self._config.get_setting("poll_timeout")
+            return self.get_fetcher().fetch(url, etag, modified, timeout)
+        else:
+            with metrics.timer("parse", url):
+                return feedparser.parse(url, etag=etag, modified=modified)
+
+    def stream_feed(self, url, etag=None, modified=None, stop_link=None):
+        """Download and parse the given feed like fetch_feed, but one entry at
+        a time with iter_entries, keeping only the fields used by the feed's
+        formats. The entries are a generator, which reads the feed as they
+        are processed, so that the whole feed is never held in memory."""
+
+        p = feedparser.FeedParserDict(entries=[], bozo=0)
+        timeout = None
+        if url.startswith("http://") or url.startswith("https://"):
+            timeout = self._config.get_setting("poll_timeout")
+            with metrics.timer("fetch", url):
+                response = self.get_fetcher().open(url, etag, modified,
+                                                   timeout, stream=True)
+            p["status"] = response.status_code
+            p["href"] = response.url
+            p["etag"] = response.headers.get("etag")
+            p["modified"] = response.headers.get("last-modified")
+            if response.status_code == 304 or response.status_code >= 400:
+                response.close()
+                return p
+            source = response.raw
+        elif "://" in url:
+            # Leave file, feed and other URLs to feedparser
+            return self.parse_feed(url, etag, modified)
+        else:
+            response = source = open(url, "rb")
+        p["entries"] = self._stream_entries(url, response, source, timeout,
+                                            stop_link, etag, modified)
+        return p
+
+    def _stream_entries(self, url, response, source, timeout, stop_link,
+                        etag, modified):
+        """Generate the entries of a feed opened by stream_feed, giving up
+        once reading them has taken timeout seconds. Stop reading at the
+        entry with the given stop_link, so long as the entries before it are
+        listed newest first. A feed which turns out not to be well-formed XML
+        is parsed in full by feedparser instead, which copes with many such
+        feeds, and its entries are generated from the start again."""
+
+        ordered = True
+        previous = None
+        count = 0
+        # Time spent reading, leaving out the time taken by the consumer
+        elapsed = 0.0
+        start = time()
+        try:
+            for entry in iter_entries(source, self.read_fields(url)):
+                elapsed += time() - start
+                if timeout and elapsed > timeout:
+                    raise requests.exceptions.Timeout(
+                        "Download of %s took too long" % url)
+                count += 1
+                yield entry
+                start = time()
+                date = self.entry_date(entry)
+                if date is None or (previous and date > previous):
+                    ordered = False
+                previous = date
+                if ordered and stop_link and entry.get("link") == stop_link:
+                    logging.debug("  Stopped reading feed %s at entry %d",
+                                  url, count)
+                    break
+        except SyntaxError, e:
+            logging.warning("Feed %s is not well-formed, parsing it in full: "
+                            "%s", url, e)
+            count = None
+        finally:
+            response.close()
+            metrics.observe("parse", url, elapsed + time() - start)
+        if count is None:
+            for entry in self.parse_feed(url, etag, modified).entries:
+                yield entry
+
+    def scan_feed(self, url):
+        """Poll the given feed and then update the database with new info"""
+
+        etag, modified = self._spigotdb.get_feed_cache(url)
+        p = self.fetch_feed(url, etag, modified, self._stop_link(url))
+        self.handle_feed(url, p)
+
+    def feed_error(self, p):
+        """Return a description of why the parsed feed p could not be read,
+        or None if it was read."""
+
+        status = p.get("status")
+        if status is not None and status >= 400:
+            return "HTTP status %d" % status
+        if p.get("bozo") and not p.entries:
+            e = p.get("bozo_exception")
+            return "%s: %s" % (e.__class__.__name__, e)
+        return None
+
+    def handle_feed(self, url, p):
+        """Process the parsed feed p if it could be read, or else count a
+        failure towards the feed's circuit breaker."""
+
+        error = self.feed_error(p)
+        if error is None:
+            try:
+                # Committed along with the rest of the poll by process_feed
+                self._spigotdb.clear_feed_failures(url, commit=False)
+                self.process_feed(url, p)
+            except Exception, e:
+                logging.exception("Unable to process feed %s", url)
+                self._spigotdb.rollback()
+                error = "%s: %s" % (e.__class__.__name__, e)
+        if error is not None:
+            self.record_failure(url, error)
+
+    def record_failure(self, url, error):
+        """Record a failed poll of the given feed, and leave it alone for a
+        while once it has failed breaker_threshold times in a row."""
+
+        failures, retry_at = self._spigotdb.record_feed_failure(
+            url, error, self._config.get_setting("breaker_threshold"),
+            self._config.get_setting("breaker_delay"),
+            self._config.get_setting("breaker_max_delay"))
+        metrics.incr("poll_failures", url)
+        if retry_at:
+            logging.warning("Feed %s has failed %d times, retrying after %s: "
+                            "%s", url, failures, retry_at, error)
+        else:
+            logging.warning("Feed %s failed: %s", url, error)
+
+    def process_feed(self, url, p):
+        """Update the database with new items from the parsed feed p. The
+        entries of a streamed feed are processed a chunk at a time as they
+        are read. Everything learnt from the poll is committed at once by
+        record_poll."""
+
+        if p.get("status") == 304:
+            logging.debug("Feed %s has not changed since last poll", url)
+            metrics.incr("not_modified", url)
+            self.record_poll(url)
+            return
+        incremental = self._config.get_setting("incremental_scan")
+        streamed = not isinstance(p.entries, list)
+        if streamed:
+            # Streamed entries are read as they are processed, and stop at
+            # the newest entry of the last scan
+            chunks = iter_chunks(p.entries, self.stream_chunk)
+        else:
+            chunks = [p.entries]
+        num_items = new_items = 0
+        dates = []
+        newest_link = None
+        for chunk in chunks:
+            num_items += len(chunk)
+            dates.extend([self.entry_date(entry) for entry in chunk])
+            # Items are told apart by their links, so entries without one
+            # are left out rather than failing the whole feed
+            entries = [entry for entry in chunk if entry.get("link")]
+            if len(entries) < len(chunk):
+                logging.warning("Skipping %d entries without a link in feed "
+                                "%s", len(chunk) - len(entries), url)
+            if not streamed:
+                incremental = incremental and self.entries_ordered(entries)
+                if incremental:
+                    entries = self.new_entries(url, entries)
+            if newest_link is None and entries:
+                newest_link = entries[0].link
+            new_items += self.add_entries(url, entries)
+        logging.debug("Found %d items in feed %s", num_items, url)
+        if streamed:
+            incremental = incremental and None not in dates and all(
+                dates[i] <= dates[i - 1] for i in range(1, len(dates)))
+        metrics.incr("entries", url, num_items)
+        logging.debug("Found %d new items in feed %s", new_items, url)
+        metrics.incr("items_added", url, new_items)
+        if incremental and newest_link:
+            self._spigotdb.set_newest_link(url, newest_link, commit=False)
+        # Remember the server's cache headers only along with the items
+        if "status" in p:
+            self._spigotdb.set_feed_cache(url, p.get("etag"),
+                                          p.get("modified"), commit=False)
+        self.record_poll(url, dates, new_items)
+
+    def add_entries(self, url, entries):
+        """Format those of the given entries of a feed which are not yet in
+        the database and add them to it. Return the number of items added."""
+
+        # Only items not yet in the database need to be formatted
+        with metrics.timer("dedup", url):
+            known = self._spigotdb.known_links([entry.link
+                                                for entry in entries])
+        render_at_post = self._config.get_setting("render_at_post")
+        items = []
+        start = time()
+        for i in range(len(entries)):
+            logging.debug("  Processing item %d", i)
+            link = entries[i].link
+            logging.debug("    Link: %s", link)
+            if link in known:
+                logging.debug("    Already in database")
+                continue
+            title = entries[i].get("title")
+            logging.debug("    Title: %s", title)
+            date = self.entry_date(entries[i])
+            if date is None:
+                # Undated entries are taken to be new when first seen
+                date_struct = self._poll_time or datetime.utcnow()
+            else:
+                date_struct = datetime.fromtimestamp(mktime(date))
+            logging.debug("    Date: %s", date_struct)
+            if render_at_post:
+                # Keep the raw fields to format the item with when posted
+                fields = self.get_fields(url, entries[i])
+                entry = json.dumps(fields, separators=(",", ":"))
+                items.append((link, None, None, date_struct, entry))
+                continue
             # Craft the message based feed format string
-            message = self.format_element(url, p.entries[i], "format")
-            logging.debug("    Message: %s" % message)
-            note_title = self.format_element(url, p.entries[i], "title")
-            logging.debug("    Note Title: %s" % note_title)
-            # Check to see if item has already entered the database
-            if not self._spigotdb.check_link(link):
-                logging.debug("    Not in database")
-                self._spigotdb.add_item(url, link, message, note_title,
-                                        date_struct)
-                new_items += 1
+            message = self.format_element(url, entries[i], "format")
+            logging.debug("    Message: %s", message)
+            note_title = self.format_element(url, entries[i], "title")
+            logging.debug("    Note Title: %s", note_title)
+            items.append((link, message, note_title, date_struct))
+        metrics.observe("render", url, time() - start)
+        # Known items are filtered out by the database in a single batch
+        with metrics.timer("insert", url):
+            return self._spigotdb.add_items(url, items, commit=False)
+
+    def record_poll(self, url, dates=(), new_items=0):
+        """Record a poll of the given feed whose entries had the given dates,
+        of which new_items were new. With adaptive_polling, also update the
+        feed's estimated rate of new items per day and schedule its next poll
+        for when about one new item is expected. This commits any pending
+        changes to the database, such as those of process_feed."""
+
+        polled = self._poll_time or datetime.utcnow()
+        if not self._config.get_setting("adaptive_polling"):
+            self._spigotdb.set_poll_time(url, polled)
+            return
+        last_polled, rate = self._spigotdb.get_poll_state(url)
+        # The feed's own entries show how often it has been updated, and the
+        # new items since the last poll how often it is now
+        rates = []
+        dates = [date for date in dates if date]
+        if dates:
+            oldest = datetime.fromtimestamp(mktime(min(dates)))
+            span = polled - oldest
+            seconds = span.days * 86400 + span.seconds
+            if seconds > 0:
+                rates.append(len(dates) * 86400.0 / seconds)
+        if last_polled and polled > last_polled:
+            span = polled - last_polled
+            seconds = span.days * 86400 + span.seconds
+            if seconds > 0:
+                rates.append(new_items * 86400.0 / seconds)
+        observed = max(rates or [0.0])
+        if rate is None:
+            rate = observed
+        else:
+            # Smooth out the odd burst or quiet spell
+            rate = (rate + observed) / 2
+        min_interval = self._config.get_setting("poll_min_interval")
+        max_interval = self._config.get_setting("poll_max_interval")
+        interval = max_interval
+        if rate > 0:
+            interval = min(max(24 * 60 / rate, min_interval), max_interval)
+        next_poll = polled + timedelta(minutes=interval)
+        logging.debug("Feed %s has %.2f new items a day, next poll at %s",
+                      url, rate, next_poll)
+        self._spigotdb.set_poll_time(url, polled, next_poll, rate)
+
+    def due_polls(self):
+        """Return the configured feeds which are due to be polled: those past
+        the next poll time set by adaptive_polling, or else those not polled
+        within the cron_poll_interval, or every feed if neither is set. Feeds
+        which keep failing are left out until their next retry."""
+
+        now = datetime.utcnow()
+        retry_times = self._spigotdb.get_retry_times()
+        urls = [feed[0] for feed in self._config.get_feeds()
+                if retry_times.get(feed[0]) is None or
+                retry_times[feed[0]] <= now]
+        if self._config.get_setting("adaptive_polling"):
+            next_polls = self._spigotdb.get_next_polls()
+            return [url for url in urls
+                    if next_polls.get(url) is None or next_polls[url] <= now]
+        interval = self._config.get_setting("cron_poll_interval")
+        if not interval:
+            return urls
+        poll_times = self._spigotdb.get_poll_times()
+        due = []
+        for url in urls:
+            polled = poll_times.get(url)
+            if polled is None or polled + timedelta(minutes=interval) <= now:
+                due.append(url)
+        return due
+
+    def nothing_due(self):
+        """Return True if no feed is due to be polled, and no feed with
+        unposted items may post yet. Needs only the configuration and a few
+        database queries, so that idle runs can finish quickly."""
+
+        if self.due_polls():
+            return False
+        now = datetime.utcnow()
+        feeds = self._config["feeds"]
+        for item in self._spigotdb.get_next_items():
+            feed, latest = item[0], item[-1]
+            if not self._config.handles_feed(feed):
+                continue
+            interval = int(feeds[feed]["interval"])
+            if latest is None or latest + timedelta(minutes=interval) <= now:
+                return False
+        return True
+
+    def get_health(self):
+        """Return a list of (url, state, failures, polled, retry_at,
+        last_error) tuples giving the health of each configured feed, the
+        least healthy first. The state is "ok", "failing", or "open" while a
+        feed which keeps failing waits for its next retry."""
+
+        health = self._spigotdb.get_feed_health()
+        now = datetime.utcnow()
+        feeds = []
+        for url, account, interval, form in self._config.get_feeds():
+            polled, failures, last_error, retry_at = health.get(
+                url, (None, 0, None, None))
+            failures = failures or 0
+            if retry_at and retry_at > now:
+                state = "open"
+            elif failures:
+                state = "failing"
             else:
-                logging.debug("    Already in database")
-        logging.debug("Found %d new items in feed %s" % (new_items, url))
+                state = "ok"
+            feeds.append((url, state, failures, polled, retry_at,
+                          last_error))
+        feeds.sort(key=lambda feed: (-feed[2], feed[0]))
+        return feeds
+
+    def entry_date(self, entry):
+        """Return the time an entry was published, falling back to the time
+        it was updated, as a struct_time or None."""
+
+        # Check for published_parsed, fall back to updated. Either is None
+        # if feedparser could not parse the date.
+        if entry.get("published_parsed"):
+            return entry.published_parsed
+        else:
+            return entry.get("updated_parsed")
 
-    def feed_ok_to_post(self, feed):
-        """Return True if the given feed is OK to post given its configured
-        interval."""
+    def entries_ordered(self, entries):
+        """Return True if every entry is dated and they are listed newest
+        first, so that incremental scanning can be relied upon."""
+
+        dates = [self.entry_date(entry) for entry in entries]
+        if None in dates:
+            return False
+        for i in range(1, len(dates)):
+            if dates[i] > dates[i - 1]:
+                logging.debug("  Entries are not in order, scanning all")
+                return False
+        return True
+
+    def new_entries(self, url, entries):
+        """Return the entries listed before the newest entry seen when the
+        given feed was last scanned, or all of them if it is not listed."""
+
+        newest_link = self._spigotdb.get_newest_link(url)
+        for i in range(len(entries)):
+            if entries[i].get("link") == newest_link:
+                logging.debug("  Found %d entries newer than last scan", i)
+                return entries[:i]
+        return entries
+
+    def next_post_time(self, feed):
+        """Return the datetime from which the given feed may be posted given
+        its configured interval, or None if it has never been posted."""
 
         interval = int(self._config["feeds"][feed]["interval"])
-        delta = timedelta(minutes=interval)
         posted = self._spigotdb.get_latest_post(feed)
         if posted:
-            next = posted + delta
+            return posted + timedelta(minutes=interval)
+        else:
+            return None
+
+    def feed_ok_to_post(self, feed):
+        """Return True if the given feed is OK to post given its configured
+        interval."""
+
+        next = self.next_post_time(feed)
+        if next:
             now = datetime.utcnow()
             if now >= next:
                 # post it
-                logging.debug("  Feed %s is ready for a new post" % feed)
+                logging.debug("  Feed %s is ready for a new post", feed)
                 return True
             else:
-                logging.debug("  Feed %s has been posted too recently" % feed)
-                logging.debug("  Next post at %s" % next.isoformat())
+                logging.debug("  Feed %s has been posted too recently", feed)
+                logging.debug("  Next post at %s", next)
                 return False
         else:
             # Nothing has been posted for this feed, so it is OK to post
-            logging.debug("  Feed %s is ready for a new post" % feed)
+            logging.debug("  Feed %s is ready for a new post", feed)
             return True
 
 
@@ -440,49 +2613,375 @@ class SpigotPost():
         self._config = spigot_config
         self._spigotfeed = spigot_feed
 
+    def plan_posts(self):
+        """Return a list of (feed, account, item) tuples, one for each
+        configured feed which may post now, with the (feed, link, message,
+        title, entry) item it should post.
+
+        The oldest unposted item and latest post time of every feed come from
+        a single query, so no connection is made while planning."""
+
+        plan = []
+        now = datetime.utcnow()
+        for row in self._spigotdb.get_next_items():
+            feed, link, message, title, entry, latest = row
+            if not self._config.handles_feed(feed):
+                continue
+            interval = int(self._config["feeds"][feed]["interval"])
+            if latest and now < latest + timedelta(minutes=interval):
+                logging.debug("  Feed %s has been posted too recently", feed)
+                continue
+            account = self._config["feeds"][feed]["account"]
+            plan.append((feed, account, (feed, link, message, title, entry)))
+        logging.debug("Found %d feeds ready for a new post", len(plan))
+        return plan
+
     def post_items(self):
         """Handle the posting of unposted items.
 
-        Iterate over each pollable feed and check to see if it is permissible
-        to post new items based on interval configuration. Loop while it is OK,
-        and terminate the loop when it becomes not OK. Presumably one or none
-        will be posted each time this method runs."""
-
-        for feed, account, interval, form in self._config.get_feeds():
-            logging.debug("Finding eligible posts in feed %s" % feed)
-            unposted_items = self._spigotdb.get_unposted_items(feed)
-            # Initialize Pump.IO connection here
-            client = Client(
-                webfinger=account,
-                type="native",
-                name="Spigot")
-            pump = PyPump(
-                client=client,
-                verifier_callback=simple_verifier)
-
-            while self._spigotfeed.feed_ok_to_post(feed):
-                try:
-                    item = unposted_items.pop(0)
-                except:
-                    # Escape the loop if there are no new posts waiting
-                    break
-                feed = item[0]
-                link = item[1]
-                message = item[2]
-                # Optional title
-                title = None
-                if item[3]:
-                    title = item[3]
+        Plan which feeds may post and which item each would send, then post
+        them, connecting only to the accounts which have work. Presumably one
+        or none will be posted per feed each time this method runs, although
+        feeds without an interval post all of their waiting items."""
 
+        plan = self.plan_posts()
+        workers = int(self._config.get_setting("post_workers"))
+        if workers > 1 and len(plan) > 1:
+            sent = self._post_concurrent(plan, workers)
+        else:
+            sent = []
+            failed_accounts = set()
+            for feed, account, item in plan:
+                # Leave the rest of an account's items for a later run once
+                # one has failed, as its server is likely unavailable
+                if account in failed_accounts:
+                    continue
+                if self.send_item(account, item):
+                    sent.append(feed)
+                else:
+                    failed_accounts.add(account)
+        for feed, account, item in plan:
+            if feed in sent and int(
+                    self._config["feeds"][feed]["interval"]) <= 0:
+                self.post_feed(feed, account)
+
+    def _post_concurrent(self, plan, workers):
+        """Send the planned items using a pool of worker threads, and mark
+        those sent posted, and those which failed for retry, in a single
+        commit each. Return the feeds posted.
+
+        Each account's items are sent in turn by one worker, which stops at
+        the first failure, and at most post_host_limit accounts on the same
+        server are posted to at once."""
+
+        accounts = {}
+        for feed, account, item in plan:
+            accounts.setdefault(account, []).append(item)
+        host_limit = int(self._config.get_setting("post_host_limit"))
+        hosts = {}
+        pending = Queue.Queue()
+        results = Queue.Queue()
+        for account in accounts:
+            host = account.split("@")[-1].lower()
+            if host not in hosts:
+                hosts[host] = threading.BoundedSemaphore(host_limit)
+            pending.put((account, hosts[host]))
+
+        def worker():
+            while True:
                 try:
-                    logging.info("  Posting item %s from %s to account %s"
-                                 % (link, feed, account))
-                    new_note = pump.Note(message, title)
-                    new_note.to = pump.Public
-                    new_note.send()
-                    self._spigotdb.mark_posted(link)
-                except:
-                    logging.exception("  Unable to post item")
+                    account, host = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                host.acquire()
+                try:
+                    for item in accounts[account]:
+                        error = self.send_note(account, item)
+                        results.put((item[0], item[1], datetime.utcnow(),
+                                     error))
+                        if error:
+                            break
+                finally:
+                    host.release()
+
+        workers = min(workers, len(accounts))
+        logging.debug("Posting to %d accounts with %d workers",
+                      len(accounts), workers)
+        threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=worker, name="post-%d" % i)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        attempts = []
+        while not results.empty():
+            attempts.append(results.get())
+        posted = [(feed, link, date)
+                  for feed, link, date, error in attempts if not error]
+        failed = [(feed, link, error)
+                  for feed, link, date, error in attempts if error]
+        self._spigotdb.mark_posted_items([(link, date)
+                                          for feed, link, date in posted])
+        self.mark_failed(failed)
+        return [feed for feed, link, date in posted]
+
+    def post_feed(self, feed, account):
+        """Post unposted items of the given feed to the given account for as
+        long as the feed's interval allows."""
+
+        logging.debug("Finding eligible posts in feed %s", feed)
+        while self._spigotfeed.feed_ok_to_post(feed):
+            items = self._spigotdb.get_next_items(feed)
+            if not items:
+                # Escape the loop if there are no new posts waiting
+                break
+            if not self.send_item(account, items[0][:5]):
+                break
+
+    def send_item(self, account, item):
+        """Post the given (feed, link, message, title, entry) item to the
+        given account and mark it posted, or record the failure for a later
+        retry. Return True if successful."""
+
+        error = self.send_note(account, item)
+        if error:
+            self.mark_failed([(item[0], item[1], error)])
+            return False
+        self._spigotdb.mark_posted(item[1])
+        return True
+
+    def mark_failed(self, items):
+        """Put off the next attempt to post each of the given (feed, link,
+        error) items, giving up on those which have failed too often."""
+
+        if not items:
+            return
+        dead = self._spigotdb.mark_failed_items(
+            [(link, error) for feed, link, error in items],
+            self._config.get_setting("retry_delay"),
+            self._config.get_setting("retry_max_delay"),
+            self._config.get_setting("retry_limit"))
+        for feed, link, error in items:
+            if link in dead:
+                logging.error("  Giving up on item %s from %s: %s", link,
+                              feed, error)
+                metrics.incr("dead_lettered", feed)
+
+    def send_note(self, account, item):
+        """Post the given (feed, link, message, title, entry) item to the
+        given account as a public note. Return None if successful, or else a
+        description of the error. Does not touch the database, so it is safe
+        to call from a worker thread."""
+
+        feed, link, message, title, entry = item
+        if entry is not None:
+            # Stored with render_at_post, so format with the current config
+            with metrics.timer("render", feed):
+                fields = json.loads(entry)
+                message = self._spigotfeed.render(feed, fields, "format")
+                title = self._spigotfeed.render(feed, fields, "title")
+        # Optional title
+        if not title:
+            title = None
+
+        try:
+            # Pump.IO connections are shared by all feeds posting to an
+            # account
+            pump = self._config.accounts.get_pump(account)
+            logging.info("  Posting item %s from %s to account %s",
+                         link, feed, account)
+            with metrics.timer("post", feed):
+                new_note = pump.Note(message, title)
+                new_note.to = pump.Public
+                new_note.send()
+            metrics.incr("posts", feed)
+            return None
+        except Exception, e:
+            logging.exception("  Unable to post item")
+            metrics.incr("post_errors", feed)
+            return "%s: %s" % (e.__class__.__name__, e)
+
+
+class SpigotDaemon():
+    """Run spigot as a long-running process which polls and posts each feed
+    when it falls due, rather than everything on each run from cron.
+
+    Pending work is kept in a priority queue of (due, sequence, action, feed)
+    tuples, where action is either "poll" or "post". An event is superseded
+    when the same action is scheduled again for its feed."""
+
+    # Longest time to sleep between checks for configuration changes
+    max_sleep = 60
+    # Time between prunes of the database when auto_prune is set
+    prune_every = timedelta(hours=24)
+    # Time to wait before retrying an event which raised an error
+    retry_wait = timedelta(minutes=1)
+
+    def __init__(self, db, spigot_config, spigot_feed, spigot_post):
+        self._spigotdb = db
+        self._config = spigot_config
+        self._spigotfeed = spigot_feed
+        self._spigotpost = spigot_post
+        self._queue = []
+        self._due = {}
+        self._seq = 0
+        self._config_stamp = None
+        self._last_prune = None
+
+    def schedule(self, action, feed, due):
+        """Queue the given action for the given feed at the datetime due,
+        replacing any event already queued for them."""
+
+        self._due[(action, feed)] = due
+        self._seq += 1
+        heapq.heappush(self._queue, (due, self._seq, action, feed))
+        logging.debug("Scheduled %s of feed %s at %s", action, feed, due)
+
+    def schedule_post(self, feed, not_before=None):
+        """Queue the next post of the given feed for when its interval allows,
+        if it has any unposted items."""
+
+        if not self._spigotdb.has_unposted_items(feed):
+            return
+        due = self._spigotfeed.next_post_time(feed) or datetime.utcnow()
+        if not_before and due < not_before:
+            due = not_before
+        self.schedule("post", feed, due)
+
+    def reset(self):
+        """Discard the queue and schedule a poll of every configured feed,
+        straight away or when adaptive polling or a failing feed's next retry
+        has it due. Posts are scheduled after each poll."""
+
+        self._queue = []
+        self._due = {}
+        now = datetime.utcnow()
+        next_polls = {}
+        if self._config.get_setting("adaptive_polling"):
+            next_polls = self._spigotdb.get_next_polls()
+        retry_times = self._spigotdb.get_retry_times()
+        for url, account, interval, form in self._config.get_feeds():
+            self.schedule("poll", url, max(next_polls.get(url, now),
+                                           retry_times.get(url, now), now))
+
+    def run_pending(self):
+        """Run every queued event which is due. Due polls are run together so
+        that they share the poll_feeds worker pool."""
+
+        now = datetime.utcnow()
+        polls = []
+        posts = []
+        while self._queue and self._queue[0][0] <= now:
+            due, seq, action, feed = heapq.heappop(self._queue)
+            if self._due.get((action, feed)) != due:
+                # Superseded by a later call to schedule
+                continue
+            del self._due[(action, feed)]
+            if not self._config.handles_feed(feed):
+                continue
+            if action == "poll":
+                polls.append(feed)
+            else:
+                posts.append(feed)
+
+        if polls:
+            try:
+                self.run_polls(polls, now)
+            except Exception:
+                # Such as the database being locked by another worker
+                logging.exception("Unable to poll %d feeds", len(polls))
+                self._spigotdb.rollback()
+                for feed in polls:
+                    self.schedule("poll", feed, now + self.retry_wait)
+        for feed in posts:
+            try:
+                account = self._config["feeds"][feed]["account"]
+                self._spigotpost.post_feed(feed, account)
+                # Do not retry straight away if posting failed
+                self.schedule_post(feed, not_before=now + self.retry_wait)
+            except Exception:
+                logging.exception("Unable to post feed %s", feed)
+                self._spigotdb.rollback()
+                self.schedule("post", feed, now + self.retry_wait)
+        if polls or posts:
+            metrics.export(self._config)
+
+    def run_polls(self, polls, now):
+        """Poll the given feeds, then schedule the next poll of each and a
+        post of any feed with new items."""
+
+        self._spigotfeed.poll_feeds(polls)
+        interval = self._config.get_setting("poll_interval")
+        next_poll = now + timedelta(minutes=interval)
+        next_polls = {}
+        if self._config.get_setting("adaptive_polling"):
+            next_polls = self._spigotdb.get_next_polls()
+        retry_times = self._spigotdb.get_retry_times()
+        for feed in polls:
+            # Feeds which failed to poll keep a next poll in the past
+            due = next_polls.get(feed)
+            if due is None or due <= now:
+                due = next_poll
+            # Feeds which keep failing wait for their next retry
+            due = max(due, retry_times.get(feed, due))
+            self.schedule("poll", feed, due)
+            if ("post", feed) not in self._due:
+                self.schedule_post(feed)
+
+    def prune_if_due(self):
+        """Prune the database every prune_every if auto_prune is set, starting
+        when the daemon starts."""
+
+        if not self._config.prunes_db():
+            return
+        now = datetime.utcnow()
+        if self._last_prune and now - self._last_prune < self.prune_every:
+            return
+        self._last_prune = now
+        max_age, per_feed = self._config.get_retention()
+        self._spigotdb.prune(max_age, per_feed)
+
+    def check_config(self):
+        """Reload the configuration and reset the queue if the configuration
+        file, or the feeds stored in the database, have changed since it was
+        last loaded."""
+
+        stamp = self._config.get_stamp()
+        if stamp != self._config_stamp:
+            if self._config_stamp is not None:
+                logging.info("Configuration changed, reloading")
+                self._config.load()
+            self._config_stamp = stamp
+            self.reset()
+
+    def run(self):
+        """Run scheduled events until interrupted."""
+
+        logging.info("spigot daemon started")
+        while True:
+            wait = self.max_sleep
+            try:
+                self.check_config()
+                # Renew this worker's leases, taking up any feeds newly free
+                if self._config.worker is not None:
+                    if claim_feeds(self._config, self._spigotdb):
+                        self.reset()
+                self.run_pending()
+                self.prune_if_due()
+                if self._queue:
+                    until = self._queue[0][0] - datetime.utcnow()
+                    # Round up so as not to wake just before the event is due
+                    until = until.days * 86400 + until.seconds + 1
+                    wait = min(wait, max(until, 0))
+            except Exception:
+                # Keep running through errors, such as a locked database or
+                # a configuration file caught half written
+                logging.exception("Error in daemon, retrying in %d seconds",
+                                  wait)
+                self._spigotdb.rollback()
+            sleep(wait)
 
 
 if __name__ == "__main__":
@@ -490,10 +2989,22 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--version", "-v", action="store_true")
     parser.add_argument("--add-feed", "-f", action="store_true")
+    parser.add_argument("--remove-feed", metavar="FEED_URL")
+    parser.add_argument("--prune", "-p", action="store_true")
+    parser.add_argument("--daemon", "-d", action="store_true")
+    parser.add_argument("--profile", nargs="?", const="spigot.pstats",
+                        metavar="PSTATS_FILE")
+    parser.add_argument("--profile-top", type=int, default=25, metavar="N")
+    parser.add_argument("--import-config", metavar="JSON_FILE")
+    parser.add_argument("--export-config", metavar="JSON_FILE")
+    parser.add_argument("--worker", "-w", type=int, metavar="INDEX")
+    parser.add_argument("--health", action="store_true")
     log_levels = ["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"]
     parser.add_argument("--log-level", "-l", choices=log_levels,
                         default="WARNING")
     args = parser.parse_args()
+    if args.profile and args.daemon:
+        parser.error("--profile cannot be used with --daemon")
 
     # Logging configuration
     logging.basicConfig(level=args.log_level,
@@ -522,16 +3033,97 @@ if __name__ == "__main__":
             logging.error("Please upgrade the config using the \
 utils/convert.py script found in the source repository.")
             sys.exit(2)
+    if args.worker is not None:
+        workers = spigot_config.get_setting("workers")
+        if not 0 <= args.worker < workers:
+            logging.error("Worker must be from 0 to %d", workers - 1)
+            sys.exit(2)
+        spigot_config.set_worker(args.worker)
+    if args.import_config:
+        spigot_config.import_feeds(args.import_config)
+        sys.exit(0)
+    if args.export_config:
+        spigot_config.export(args.export_config)
+        sys.exit(0)
+    if args.remove_feed:
+        if not spigot_config.remove_feed(args.remove_feed):
+            logging.error("Feed %s is not configured", args.remove_feed)
+            sys.exit(2)
+        sys.exit(0)
 
-    spigot_db = SpigotDB()
-    # Test for pre-2.2 database structure
-    if spigot_db.check_old_db():
-        logging.error("Existing database not upgraded for the latest spigot")
-        logging.error("Please upgrade the database using the \
-utils/convert.py script found in the source repository.")
-        sys.exit(2)
-
+    # Existing databases are upgraded to the latest schema on connect
+    # The sqlite config backend already has a connection to share
+    spigot_db = spigot_config.get_store() or SpigotDB()
+    if spigot_config.worker is not None:
+        # Other workers share the database and take the other feeds
+        spigot_db.enable_wal()
+        claim_feeds(spigot_config, spigot_db)
     spigot_feed = SpigotFeeds(spigot_db, spigot_config)
-    spigot_feed.poll_feeds()
+    if args.health:
+        def when(date):
+            return date and date.strftime("%Y-%m-%d %H:%M:%S") or "-"
+
+        print "%-7s %8s  %-19s  %-19s  %s" % ("state", "failures",
+                                              "last polled", "next retry",
+                                              "feed")
+        health = spigot_feed.get_health()
+        for url, state, failures, polled, retry_at, last_error in health:
+            print "%-7s %8d  %-19s  %-19s  %s" % (state, failures,
+                                                  when(polled),
+                                                  when(retry_at), url)
+            if last_error:
+                print "        %s" % last_error
+        spigot_db.close()
+        sys.exit(0)
+    # Finish idle cron runs before doing anything slow
+    if not (args.prune or args.daemon or args.profile):
+        if spigot_feed.nothing_due():
+            logging.debug("No feeds are due to be polled or posted")
+            spigot_db.close()
+            sys.exit(0)
+    link_cache = spigot_config.get_setting("link_cache")
+    if link_cache:
+        spigot_db.enable_link_cache(persist=(link_cache == "file"))
+    if spigot_config.get_setting("compress_messages"):
+        spigot_db.enable_compression()
+    max_age, per_feed = spigot_config.get_retention()
+    if args.prune:
+        if not (max_age or per_feed):
+            logging.warning("No retention_days or retention_per_feed set")
+        spigot_db.prune(max_age, per_feed)
+        spigot_db.close()
+        sys.exit(0)
+
     spigot_post = SpigotPost(spigot_db, spigot_config, spigot_feed)
-    spigot_post.post_items()
+    if args.daemon:
+        # Exit cleanly when asked to stop
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        metrics_port = spigot_config.get_setting("metrics_port")
+        if metrics_port:
+            serve_metrics(metrics_port)
+        spigot_daemon = SpigotDaemon(spigot_db, spigot_config, spigot_feed,
+                                     spigot_post)
+        try:
+            spigot_daemon.run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            spigot_db.close()
+        sys.exit(0)
+
+    def run():
+        spigot_feed.poll_feeds()
+        spigot_post.post_items()
+
+    if args.profile:
+        # Only the main thread is profiled, so do all the work there
+        settings = spigot_config.setdefault("settings", {})
+        settings["poll_workers"] = settings["post_workers"] = 1
+        profile_run(run, args.profile, args.profile_top)
+    else:
+        run()
+    if spigot_config.prunes_db():
+        spigot_db.prune(max_age, per_feed)
+    spigot_db.close()
+    metrics.log_summary()
+    metrics.export(spigot_config)
@@ -1,8 +1,15 @@
 #! /usr/bin/env python
 
+import BaseHTTPServer
 import datetime
+import gzip
 import os
+import socket
+import SocketServer
 import sqlite3
+import StringIO
+import threading
+import time
 import unittest
 
 import spigot
@@ -34,6 +41,15 @@ class TestExistingConfig(SpigotConfigTest):
         self.assertFalse(old_config)
         self.assertFalse(self.config.no_config)
 
+    def test_accounts_shared(self):
+        "Feeds posting to the same account share one cached connection"
+
+        pump = object()
+        self.config.accounts["spigotdev@fmrl.me"] = pump
+        self.config.load()
+        self.assertTrue(
+            self.config.accounts.get_pump("spigotdev@fmrl.me") is pump)
+
 
 class TestNewConfig(SpigotConfigTest):
     test_config_path = "test.json"
@@ -64,9 +80,11 @@ class TestNewConfig(SpigotConfigTest):
 class SpigotDBTest(unittest.TestCase):
     test_db_path = "test.db"
     test_data = "utils/tests/test-existing.sql"
-    db_schema = [("feed", "text"), ("link", "text"), ("message", "text"),
-                 ("title", "text"), ("date", "timestamp"),
-                 ("posted", "timestamp")]
+    db_schema = [("feed_id", "integer"), ("link", "text"),
+                 ("message", "blob"), ("title", "text"), ("date", "integer"),
+                 ("posted", "integer"), ("entry", "blob"),
+                 ("attempts", "integer"), ("next_attempt", "integer"),
+                 ("last_error", "text"), ("dead_lettered", "integer")]
     det_types = sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
     old_url = "http://example.com/post/17"
     new_url = "http://example.com/post/18"
@@ -95,14 +113,54 @@ class SpigotDBTest(unittest.TestCase):
         self.db.close()
         self.db = None
         os.remove(self.test_db_path)
+        for extension in (".bak", ".links", "-wal", "-shm"):
+            if os.path.exists(self.test_db_path + extension):
+                os.remove(self.test_db_path + extension)
 
 
 class TestOldDB(SpigotDBTest):
     test_data = "utils/tests/test-old.sql"
 
     def test_db_check(self):
-        old_db = self.db.check_old_db()
-        self.assertTrue(old_db)
+        "A pre-2.2 database is upgraded in place on connect"
+
+        self.assertFalse(self.db.check_old_db())
+        self.assertEqual(self.db.get_schema_version(),
+                         spigot.SpigotDB.SCHEMA_VERSION)
+        self.assertTrue(os.path.exists(self.test_db_path + ".bak"))
+        dbtest = sqlite3.connect(self.test_db_path)
+        curs = dbtest.cursor()
+        curs.execute("PRAGMA table_info(items);")
+        cols = [col[1] for col in curs.fetchall()]
+        curs.close()
+        dbtest.close()
+        self.assertIn("message", cols)
+        self.assertIn("title", cols)
+
+
+class TestDuplicateDB(SpigotDBTest):
+    test_data = None
+    dup_url = "http://example.com/post/3"
+
+    def setUp(self):
+        dbtest = sqlite3.connect(self.test_db_path)
+        curs = dbtest.cursor()
+        curs.execute("CREATE TABLE items (feed text, link text, message text,"
+                     " title text, date timestamp, posted timestamp)")
+        for posted in (None, "2014-06-17 03:42:52", None):
+            curs.execute("INSERT INTO items VALUES (?, ?, '', '', NULL, ?)",
+                         (self.new_feed, self.dup_url, posted))
+        curs.close()
+        dbtest.commit()
+        dbtest.close()
+        SpigotDBTest.setUp(self)
+
+    def test_duplicates_removed(self):
+        "Duplicate links are merged when the link index is created"
+
+        self.assertEqual(len(self.db.get_unposted_items(self.new_feed)), 0)
+        self.assertEqual(self.db.get_latest_post(self.new_feed),
+                         datetime.datetime(2014, 6, 17, 3, 42, 52))
 
 
 class TestExistingDB(SpigotDBTest):
@@ -125,27 +183,143 @@ class TestExistingDB(SpigotDBTest):
                          date=self.new_date)
         self.assertTrue(self.db.check_link(self.new_url))
 
+    def test_add_items(self):
+        "Run add_items with new, known and repeated links"
+
+        items = [(self.new_url, self.new_message, self.new_title,
+                  self.new_date),
+                 (self.old_url, "Post #17", "Post 17", self.new_date),
+                 (self.new_url, self.new_message, self.new_title,
+                  self.new_date)]
+        added = self.db.add_items(self.new_feed, items)
+        self.assertEqual(added, 1)
+        self.assertTrue(self.db.check_link(self.new_url))
+        unposted = self.db.get_unposted_items(self.new_feed)
+        self.assertEqual(len(unposted), 7)
+
+    def test_known_links(self):
+        "Run known_links with a mix of new and known links"
+
+        known = self.db.known_links([self.old_url, self.new_url])
+        self.assertEqual(known, set([self.old_url]))
+
     def test_get_unposted_items(self):
         "Run get_unposted_items and verify that result matches test data"
 
         unposted = self.db.get_unposted_items(self.new_feed)
         self.assertEquals(len(unposted), 6)
 
+    def test_get_next_items(self):
+        "Run get_next_items and verify the oldest unposted item is next"
+
+        newest_post = datetime.datetime(2014, 6, 17, 3, 42, 52)
+        next_items = self.db.get_next_items()
+        self.assertEqual(len(next_items), 1)
+        self.assertEqual(next_items[0][1], "http://example.com/post/12")
+        self.assertEqual(next_items[0][5], newest_post)
+        self.assertEqual(self.db.get_next_items(self.new_feed), next_items)
+        self.assertEqual(self.db.get_next_items("http://example.com/"), [])
+
     def test_get_latest_post(self):
         "Run get_latest_post and verify that result matches test data"
 
-        newest_post = datetime.datetime(2014, 6, 17, 3, 42, 52, 614399)
+        newest_post = datetime.datetime(2014, 6, 17, 3, 42, 52)
         latest = self.db.get_latest_post(feed=self.new_feed)
         self.assertEqual(latest, newest_post)
 
     def test_mark_posted(self):
         "Run mark_posted and verify the update via get_latest_post"
 
-        now = datetime.datetime.now()
+        now = datetime.datetime.now().replace(microsecond=0)
         self.db.mark_posted(item_link=self.old_url, date=now)
         latest = self.db.get_latest_post(feed=self.new_feed)
         self.assertEqual(latest, now)
 
+    def test_prune_per_feed(self):
+        "Prune all but two posted items and verify they stay known"
+
+        pruned = self.db.prune(per_feed=2)
+        self.assertEqual(pruned, 3)
+        self.assertTrue(self.db.check_link("http://example.com/post/7"))
+        self.assertEqual(self.db.known_links(["http://example.com/post/8"]),
+                         set(["http://example.com/post/8"]))
+        self.assertEqual(self.db.add_items(self.new_feed, [
+            ("http://example.com/post/9", "", "", self.new_date)]), 0)
+        self.assertEqual(len(self.db.get_unposted_items(self.new_feed)), 6)
+
+    def test_prune_max_age(self):
+        "Prune by age, which always keeps the latest posted item"
+
+        pruned = self.db.prune(max_age=datetime.timedelta(days=1))
+        self.assertEqual(pruned, 4)
+        newest_post = datetime.datetime(2014, 6, 17, 3, 42, 52)
+        self.assertEqual(self.db.get_latest_post(self.new_feed), newest_post)
+
+    def test_link_cache(self):
+        "Answer link lookups from the link cache, including pruned items"
+
+        self.db.prune(per_feed=1)
+        self.db.enable_link_cache()
+        self.assertTrue(self.db.check_link(self.old_url))
+        self.assertTrue(self.db.check_link("http://example.com/post/7"))
+        self.assertFalse(self.db.check_link(self.new_url))
+        self.db.add_items(self.new_feed, [(self.new_url, self.new_message,
+                                           self.new_title, self.new_date)])
+        self.assertEqual(self.db.known_links([self.new_url, "x"]),
+                         set([self.new_url]))
+
+    def test_link_cache_rollback(self):
+        "Links of items which were rolled back are dropped from the cache"
+
+        self.db.enable_link_cache(persist=True)
+        self.db.add_items(self.new_feed, [(self.new_url, self.new_message,
+                                           self.new_title, self.new_date)],
+                          commit=False)
+        self.assertTrue(self.db.check_link(self.new_url))
+        self.db.rollback()
+        self.assertFalse(self.db.check_link(self.new_url))
+        self.db.close()
+        self.db = spigot.SpigotDB(path=self.test_db_path)
+        self.db.enable_link_cache(persist=True)
+        self.assertEqual(self.db.add_items(self.new_feed, [
+            (self.new_url, self.new_message, self.new_title,
+             self.new_date)]), 1)
+
+    def test_link_cache_file(self):
+        "A saved link cache is reloaded until the database changes"
+
+        self.db.enable_link_cache(persist=True)
+        self.db.close()
+        self.assertTrue(os.path.exists(self.test_db_path + ".links"))
+        self.db = spigot.SpigotDB(path=self.test_db_path)
+        self.db.enable_link_cache(persist=True)
+        self.assertTrue(self.db.check_link(self.old_url))
+        # A change made without the cache makes the saved file stale
+        self.db._links_file = None
+        self.db._links = None
+        self.db.add_item(self.new_feed, self.new_url, self.new_message,
+                         self.new_title, self.new_date)
+        self.db.enable_link_cache(persist=True)
+        self.assertTrue(self.db.check_link(self.new_url))
+
+    def test_link_cache_file_shared(self):
+        "A link cache saved after another process changed the db is stale"
+
+        self.db.enable_link_cache(persist=True)
+        other_db = spigot.SpigotDB(path=self.test_db_path)
+        other_db.add_item(self.new_feed, self.new_url, self.new_message,
+                          self.new_title, self.new_date)
+        other_db.mark_posted(self.new_url)
+        other_db.close()
+        self.db.prune(per_feed=1)
+        self.db.close()
+        self.db = spigot.SpigotDB(path=self.test_db_path)
+        self.db.enable_link_cache(persist=True)
+        self.assertTrue(self.db.check_link(self.new_url))
+        self.assertEqual(self.db.add_items(self.new_feed, [
+            (self.new_url, self.new_message, self.new_title,
+             self.new_date)]), 0)
+
     def test_db_check(self):
         "Test that a post-2.2 DB schema is not flagged as pre-2.2"
 
@@ -167,7 +341,1082 @@ class TestNewDB(SpigotDBTest):
         cols = curs.fetchall()
         curs.close()
         for col in cols:
-            self.assertIn((col[1], col[2]), self.db_schema)
+            self.assertIn((col[1], col[2].lower()), self.db_schema)
+        curs = dbtest.cursor()
+        curs.execute("PRAGMA index_list(items);")
+        indexes = [index[1] for index in curs.fetchall()]
+        curs.close()
+        dbtest.close()
+        for index in ("items_link", "items_feed_posted", "items_unposted"):
+            self.assertIn(index, indexes)
+
+    def test_no_partial_indexes(self):
+        "Without partial indexes, the schema is created without them"
+
+        self.db.close()
+        os.remove(self.test_db_path)
+        partial_indexes = spigot.SpigotDB.PARTIAL_INDEXES
+        spigot.SpigotDB.PARTIAL_INDEXES = False
+        try:
+            self.db = spigot.SpigotDB(path=self.test_db_path)
+        finally:
+            spigot.SpigotDB.PARTIAL_INDEXES = partial_indexes
+        curs = self.db._db.cursor()
+        curs.execute("PRAGMA index_list(items);")
+        indexes = [index[1] for index in curs.fetchall()]
+        curs.close()
+        self.assertIn("items_feed_posted", indexes)
+        self.assertNotIn("items_unposted", indexes)
+
+
+class TestCompactItems(SpigotDBTest):
+    long_message = "Post #18 - %s" % ("lorem ipsum dolor " * 20)
+
+    def test_converted(self):
+        "Existing items refer to their feed by id and store epoch times"
+
+        curs = self.db._db.cursor()
+        curs.execute("SELECT feeds.url, items.date, items.posted FROM items \
+            JOIN feeds ON feeds.id = items.feed_id WHERE link=?",
+                     ["http://example.com/post/11"])
+        feed, date, posted = curs.fetchone()
+        curs.close()
+        self.assertEqual(feed, self.new_feed)
+        self.assertEqual(spigot.from_epoch(date),
+                         datetime.datetime(2014, 3, 17, 15, 4, 25))
+        self.assertEqual(spigot.from_epoch(posted),
+                         datetime.datetime(2014, 6, 17, 3, 42, 52))
+
+    def test_compressed_message(self):
+        "Long messages are stored compressed and read back as text"
+
+        self.db.enable_compression()
+        self.db.add_items(self.new_feed, [(self.new_url, self.long_message,
+                                           self.new_title, self.new_date)])
+        curs = self.db._db.cursor()
+        curs.execute("SELECT length(message), typeof(message) FROM items \
+            WHERE link=?", [self.new_url])
+        length, kind = curs.fetchone()
+        curs.close()
+        self.assertEqual(kind, "blob")
+        self.assertTrue(length < len(self.long_message))
+        unposted = self.db.get_unposted_items(self.new_feed)
+        self.assertIn((self.new_feed, self.new_url, self.long_message,
+                       self.new_title), unposted)
+
+    def test_feed_id_rollback(self):
+        "The id of a feed added in a rolled back transaction is not reused"
+
+        self.db._feed_id("http://a.example.com/feed", create=True)
+        self.db.rollback()
+        self.db.add_items("http://b.example.com/feed", [
+            ("http://b.example.com/1", "", "", self.new_date)])
+        self.db.add_items("http://a.example.com/feed", [
+            ("http://a.example.com/1", "", "", self.new_date)])
+        next_items = self.db.get_next_items("http://a.example.com/feed")
+        self.assertEqual([item[:2] for item in next_items],
+                         [("http://a.example.com/feed",
+                           "http://a.example.com/1")])
+
+
+class TestSQLiteConfig(SpigotDBTest):
+    test_data = None
+    json_path = "test-sqlite.json"
+    export_path = "test-export.json"
+    feeds = {
+        "http://example.com/feed.xml": {
+            "account": "spigot@example.com", "interval": 60,
+            "format": "%title% - %link%", "title": "%title%"},
+        "http://example.org/feed.xml": {
+            "account": "other@example.org", "interval": 30,
+            "format": "%link%", "title": "", "to": ["followers"]},
+    }
+
+    def setUp(self):
+        SpigotDBTest.setUp(self)
+        open(self.json_path, "w").write(spigot.json.dumps({
+            "settings": {"config_backend": "sqlite"}, "feeds": self.feeds}))
+        self.config = spigot.SpigotConfig(self.json_path, self.test_db_path)
+        self.config.load()
+
+    def tearDown(self):
+        self.config.get_store().close()
+        for path in (self.json_path, self.export_path):
+            if os.path.exists(path):
+                os.remove(path)
+        SpigotDBTest.tearDown(self)
+
+    def test_import_export(self):
+        "Feeds are imported from json to the database and exported back"
+
+        self.assertEqual(self.config["feeds"], {})
+        self.assertEqual(self.config.import_feeds(self.json_path), 2)
+        self.assertEqual(self.db.get_feed_configs(), self.feeds)
+        self.assertEqual(self.db.get_feed_configs("other@example.org").keys(),
+                         ["http://example.org/feed.xml"])
+        config = spigot.SpigotConfig(self.json_path, self.test_db_path)
+        config.load()
+        self.assertEqual(config["feeds"], self.feeds)
+        config.export(self.export_path)
+        exported = spigot.json.loads(open(self.export_path).read())
+        self.assertEqual(exported["feeds"], self.feeds)
+        self.assertEqual(exported["settings"]["config_backend"], "sqlite")
+        config.get_store().close()
+
+    def test_set_feed(self):
+        "Changing one feed updates the database, feed list and stamp"
+
+        self.config.import_feeds(self.json_path)
+        feeds = self.config.get_feeds()
+        self.assertTrue(self.config.get_feeds() is feeds)
+        stamp = self.config.get_stamp()
+        url = "http://example.net/feed.xml"
+        self.config.set_feed(url, {"account": "spigot@example.com",
+                                   "interval": 5, "format": "%title%",
+                                   "title": ""})
+        self.assertNotEqual(self.config.get_stamp(), stamp)
+        self.assertEqual(len(self.config.get_feeds()), 3)
+        self.assertEqual(self.db.get_feed_configs()[url]["interval"], 5)
+        # The json file is left untouched
+        saved = spigot.json.loads(open(self.json_path).read())
+        self.assertEqual(saved["feeds"], self.feeds)
+
+    def test_remove_feed(self):
+        "Removing a feed deletes only its row and changes the stamp"
+
+        self.config.import_feeds(self.json_path)
+        stamp = self.config.get_stamp()
+        self.assertTrue(self.config.remove_feed("http://example.org/feed.xml"))
+        self.assertFalse(self.config.remove_feed("http://example.net/"))
+        self.assertNotEqual(self.config.get_stamp(), stamp)
+        self.assertEqual(self.db.get_feed_configs().keys(),
+                         ["http://example.com/feed.xml"])
+        self.assertEqual(len(self.config.get_feeds()), 1)
+
+
+class SpigotFeedsTest(SpigotDBTest):
+    test_feed = "utils/tests/test-feed.xml"
+    test_format = "%title% - %link%"
+    settings = {}
+
+    def setUp(self):
+        SpigotDBTest.setUp(self)
+        self.config = spigot.SpigotConfig("test.json")
+        self.config["settings"] = dict(self.settings)
+        self.config["feeds"] = {
+            self.test_feed: {"account": "spigot@example.com", "interval": 60,
+                             "format": self.test_format, "title": "%title%"},
+        }
+        self.feeds = spigot.SpigotFeeds(self.db, self.config)
+
+    def tearDown(self):
+        self.feeds = None
+        self.config = None
+        SpigotDBTest.tearDown(self)
+
+
+class TestScanFeed(SpigotFeedsTest):
+
+    def test_scan_feed(self):
+        "Scan the test feed and verify that its items are in the DB"
+
+        self.feeds.scan_feed(self.test_feed)
+        unposted = self.db.get_unposted_items(self.test_feed)
+        self.assertEqual(len(unposted), 3)
+        self.assertEqual(unposted[0][2],
+                         "Post #19 - http://example.com/post/19")
+
+    def test_format_element(self):
+        "Format an entry, including a missing field and a changed format"
+
+        entry = spigot.feedparser.FeedParserDict(
+            title="Post #18", link="http://example.com/post/18")
+        self.assertEqual(self.feeds.format_element(self.test_feed, entry,
+                                                   "format"),
+                         "Post #18 - http://example.com/post/18")
+        self.config["feeds"][self.test_feed]["format"] = "%link% %author%!"
+        self.assertEqual(self.feeds.format_element(self.test_feed, entry,
+                                                   "format"),
+                         "http://example.com/post/18 !")
+
+    def test_format_cache_reset(self):
+        "Compiled formats are dropped when the configuration is reloaded"
+
+        self.feeds.get_template(self.test_feed, "format")
+        self.assertEqual(len(self.feeds._templates), 1)
+        self.config.generation += 1
+        self.feeds.get_template(self.test_feed, "title")
+        self.assertEqual(self.feeds._templates.keys(), ["%title%"])
+
+    def test_scan_feed_twice(self):
+        "Scanning a feed again does not duplicate its items"
+
+        self.feeds.scan_feed(self.test_feed)
+        self.feeds.scan_feed(self.test_feed)
+        unposted = self.db.get_unposted_items(self.test_feed)
+        self.assertEqual(len(unposted), 3)
+
+
+class TestRenderAtPost(SpigotFeedsTest):
+    settings = {"render_at_post": True}
+
+    def test_raw_fields_stored(self):
+        "Items are stored unformatted and formatted with the current config"
+
+        self.feeds.scan_feed(self.test_feed)
+        next_items = self.db.get_next_items(self.test_feed)
+        feed, link, message, title, entry, latest = next_items[0]
+        self.assertEqual(message, None)
+        fields = spigot.json.loads(entry)
+        self.assertEqual(sorted(fields.keys()),
+                         ["link", "published", "title"])
+        self.config["feeds"][self.test_feed]["format"] = "New: %title%"
+        self.assertEqual(self.feeds.render(self.test_feed, fields, "format"),
+                         "New: Post #19")
+        # Fields not used by the format when the item was found can be used
+        self.config["feeds"][self.test_feed]["format"] = "%published%"
+        self.assertEqual(self.feeds.render(self.test_feed, fields, "format"),
+                         "Tue, 01 Jul 2014 14:45:00 GMT")
+
+
+class TestIncrementalScan(SpigotFeedsTest):
+    settings = {"incremental_scan": True}
+
+    def test_newest_link_stored(self):
+        "Scanning a feed records its newest entry"
+
+        self.feeds.scan_feed(self.test_feed)
+        self.assertEqual(self.db.get_newest_link(self.test_feed),
+                         "http://example.com/post/21")
+        self.assertEqual(len(self.db.get_unposted_items(self.test_feed)), 3)
+
+    def test_stop_at_newest_link(self):
+        "Only entries newer than the last scan's newest entry are processed"
+
+        self.db.set_newest_link(self.test_feed, "http://example.com/post/20")
+        self.feeds.scan_feed(self.test_feed)
+        unposted = self.db.get_unposted_items(self.test_feed)
+        self.assertEqual([item[1] for item in unposted],
+                         ["http://example.com/post/21"])
+
+    def test_unordered_entries(self):
+        "Entries which are not listed newest first are all processed"
+
+        p = self.feeds.fetch_feed(self.test_feed)
+        self.assertTrue(self.feeds.entries_ordered(p.entries))
+        p.entries.reverse()
+        self.assertFalse(self.feeds.entries_ordered(p.entries))
+        self.db.set_newest_link(self.test_feed, "http://example.com/post/20")
+        self.feeds.process_feed(self.test_feed, p)
+        self.assertEqual(len(self.db.get_unposted_items(self.test_feed)), 3)
+
+
+class TestStreamingParse(SpigotFeedsTest):
+    settings = {"streaming_parse": True, "incremental_scan": True}
+
+    def test_scan_feed(self):
+        "A streamed feed gives the same items as one parsed in full"
+
+        self.feeds.scan_feed(self.test_feed)
+        unposted = self.db.get_unposted_items(self.test_feed)
+        self.assertEqual(len(unposted), 3)
+        self.assertEqual(unposted[0][2:],
+                         ("Post #19 - http://example.com/post/19",
+                          "Post #19"))
+
+    def test_file_url(self):
+        "Feeds given by URLs other than HTTP are parsed by feedparser"
+
+        url = "file://" + os.path.abspath(self.test_feed)
+        self.config["feeds"][url] = self.config["feeds"][self.test_feed]
+        self.feeds.scan_feed(url)
+        self.assertEqual(len(self.db.get_unposted_items(url)), 3)
+
+    def test_chunks(self):
+        "Streamed entries are read a chunk at a time as they are processed"
+
+        self.feeds.stream_chunk = 1
+        p = self.feeds.stream_feed(self.test_feed)
+        self.assertFalse(isinstance(p.entries, list))
+        self.feeds.process_feed(self.test_feed, p)
+        self.assertEqual(len(self.db.get_unposted_items(self.test_feed)), 3)
+        self.assertEqual(self.db.get_newest_link(self.test_feed),
+                         "http://example.com/post/21")
+
+    def test_chunks_concurrent(self):
+        "Worker threads hand streamed entries over a chunk at a time"
+
+        other_feed = "utils/tests/test-feed.atom"
+        self.config["feeds"][other_feed] = self.config["feeds"][self.test_feed]
+        self.feeds.stream_chunk = 1
+        self.config["settings"]["poll_workers"] = 2
+        self.feeds.poll_feeds()
+        self.assertEqual(len(self.db.get_unposted_items(self.test_feed)), 3)
+        self.assertEqual(len(self.db.get_unposted_items(other_feed)), 2)
+
+    def test_stop_at_newest_link(self):
+        "Stop reading the feed at the newest entry seen on the last scan"
+
+        p = self.feeds.stream_feed(self.test_feed,
+                                   stop_link="http://example.com/post/20")
+        self.assertEqual([entry.link for entry in p.entries],
+                         ["http://example.com/post/21",
+                          "http://example.com/post/20"])
+
+    def test_atom_entries(self):
+        "Read only the requested fields of Atom entries"
+
+        entries = list(spigot.iter_entries(open("utils/tests/test-feed.atom"),
+                                           ["author", "content"]))
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(entries[0].link, "http://example.com/post/31")
+        self.assertEqual(entries[0].author, "Nathan")
+        self.assertEqual(entries[0].content[0].value, "Some <b>text</b>")
+        self.assertEqual(entries[0].published_parsed[:3], (2014, 7, 3))
+        self.assertFalse("summary" in entries[0])
+        self.assertEqual(entries[1].updated_parsed[:3], (2014, 7, 2))
+
+    def test_not_well_formed(self):
+        "A feed using HTML entities is parsed in full by feedparser"
+
+        path = "test-entities.xml"
+        out = open(path, "w")
+        out.write('<?xml version="1.0" encoding="utf-8"?>\n'
+                  '<rss version="2.0"><channel><title>Entities</title>'
+                  "<item><title>First&nbsp;post</title>"
+                  "<link>http://example.net/1</link></item>"
+                  "<item><title>Second</title>"
+                  "<link>http://example.net/2</link></item>"
+                  "</channel></rss>\n")
+        out.close()
+        self.config["feeds"][path] = dict(self.config["feeds"][self.test_feed])
+        try:
+            p = self.feeds.fetch_feed(path)
+            links = [entry.link for entry in p.entries]
+        finally:
+            os.remove(path)
+        self.assertEqual(links,
+                         ["http://example.net/1", "http://example.net/2"])
+        self.assertEqual(self.feeds.feed_error(p), None)
+
+
+class TestConditionalFetch(SpigotFeedsTest):
+    etag = '"3e86-410-3596fbbc"'
+    modified = "Thu, 03 Jul 2014 09:30:00 GMT"
+
+    def test_feed_cache_empty(self):
+        "A feed which has never been fetched has no cache headers"
+
+        self.assertEqual(self.db.get_feed_cache(self.test_feed),
+                         (None, None))
+
+    def test_feed_cache_stored(self):
+        "Cache headers of a fetched feed are stored for the next poll"
+
+        p = self.feeds.fetch_feed(self.test_feed)
+        p["status"] = 200
+        p["etag"] = self.etag
+        p["modified"] = self.modified
+        self.feeds.process_feed(self.test_feed, p)
+        self.assertEqual(self.db.get_feed_cache(self.test_feed),
+                         (self.etag, self.modified))
+
+    def test_not_modified(self):
+        "A 304 response leaves the database untouched"
+
+        self.db.set_feed_cache(self.test_feed, self.etag, self.modified)
+        p = spigot.feedparser.FeedParserDict(status=304, entries=[])
+        self.feeds.process_feed(self.test_feed, p)
+        self.assertEqual(len(self.db.get_unposted_items(self.test_feed)), 0)
+        self.assertEqual(self.db.get_feed_cache(self.test_feed),
+                         (self.etag, self.modified))
+
+
+class TestPlanPosts(SpigotFeedsTest):
+
+    def test_plan_new_feed(self):
+        "A feed which has never posted is planned with its oldest item"
+
+        self.feeds.scan_feed(self.test_feed)
+        post = spigot.SpigotPost(self.db, self.config, self.feeds)
+        plan = post.plan_posts()
+        self.assertEqual(len(plan), 1)
+        feed, account, item = plan[0]
+        self.assertEqual(account, "spigot@example.com")
+        self.assertEqual(item[1], "http://example.com/post/19")
+        self.assertEqual(self.config.accounts, {})
+
+    def test_plan_too_recent(self):
+        "A feed posted within its interval is left out of the plan"
+
+        self.feeds.scan_feed(self.test_feed)
+        self.db.mark_posted("http://example.com/post/19")
+        post = spigot.SpigotPost(self.db, self.config, self.feeds)
+        self.assertEqual(post.plan_posts(), [])
+
+
+class FakePump(object):
+    "Stands in for a PyPump connection, recording the notes sent."
+
+    Public = "public"
+
+    def __init__(self, fail=False):
+        self.sent = []
+        self.fail = fail
+
+    def Note(self, message, title):
+        pump = self
+
+        class Note(object):
+            def send(self):
+                if pump.fail:
+                    raise IOError("pump.io server unavailable")
+                pump.sent.append((message, title))
+        return Note()
+
+
+class TestConcurrentPost(SpigotFeedsTest):
+    settings = {"post_workers": 4, "post_host_limit": 1}
+    other_feed = "http://example.org/feed.xml"
+
+    def setUp(self):
+        SpigotFeedsTest.setUp(self)
+        self.config["feeds"][self.other_feed] = {
+            "account": "other@example.com", "interval": 60,
+            "format": "%title%", "title": ""}
+        self.feeds.scan_feed(self.test_feed)
+        self.db.add_items(self.other_feed, [("http://example.org/post/1",
+                                             "Post #1", "",
+                                             self.new_date)])
+        self.post = spigot.SpigotPost(self.db, self.config, self.feeds)
+
+    def test_post_items(self):
+        "Post to two accounts on the same server in parallel"
+
+        pump = FakePump()
+        other_pump = FakePump()
+        self.config.accounts["spigot@example.com"] = pump
+        self.config.accounts["other@example.com"] = other_pump
+        self.post.post_items()
+        self.assertEqual(pump.sent, [("Post #19 - http://example.com/post/19",
+                                      "Post #19")])
+        self.assertEqual(other_pump.sent, [("Post #1", None)])
+        self.assertTrue(self.db.get_latest_post(self.test_feed))
+        self.assertTrue(self.db.get_latest_post(self.other_feed))
+        self.assertEqual(self.post.plan_posts(), [])
+
+    def test_post_failure(self):
+        "An item which could not be sent is not marked posted"
+
+        self.config.accounts["spigot@example.com"] = FakePump(fail=True)
+        self.config.accounts["other@example.com"] = FakePump()
+        self.post.post_items()
+        self.assertEqual(self.db.get_latest_post(self.test_feed), None)
+        self.assertTrue(self.db.get_latest_post(self.other_feed))
+
+
+class TestPostRetry(SpigotFeedsTest):
+    settings = {"retry_delay": 5, "retry_max_delay": 60, "retry_limit": 3}
+    first_link = "http://example.com/post/19"
+
+    def setUp(self):
+        SpigotFeedsTest.setUp(self)
+        self.feeds.scan_feed(self.test_feed)
+        self.post = spigot.SpigotPost(self.db, self.config, self.feeds)
+        self.config.accounts["spigot@example.com"] = FakePump(fail=True)
+
+    def retry_state(self):
+        curs = self.db._db.cursor()
+        curs.execute("SELECT attempts, next_attempt, last_error, \
+            dead_lettered FROM items WHERE link=?", [self.first_link])
+        attempts, next_attempt, error, dead = curs.fetchone()
+        curs.close()
+        return attempts, spigot.from_epoch(next_attempt), error, dead
+
+    def make_due(self):
+        self.db._db.execute("UPDATE items SET next_attempt=? \
+            WHERE next_attempt IS NOT NULL",
+                            [spigot.to_epoch(datetime.datetime.utcnow())])
+
+    def test_backoff(self):
+        "A failed item waits longer after each failure before a retry"
+
+        self.post.post_items()
+        attempts, next_attempt, error, dead = self.retry_state()
+        self.assertEqual(attempts, 1)
+        wait = next_attempt - datetime.datetime.utcnow()
+        self.assertTrue(datetime.timedelta(minutes=4) < wait <=
+                        datetime.timedelta(minutes=5))
+        self.assertEqual(error, "IOError: pump.io server unavailable")
+        # The feed waits for the retry without trying the network
+        self.assertEqual(self.post.plan_posts(), [])
+        self.assertEqual(len(self.db.get_unposted_items(self.test_feed)), 2)
+        self.make_due()
+        self.post.post_items()
+        attempts, next_attempt, error, dead = self.retry_state()
+        self.assertEqual(attempts, 2)
+        wait = next_attempt - datetime.datetime.utcnow()
+        self.assertTrue(datetime.timedelta(minutes=9) < wait)
+
+    def test_dead_letter(self):
+        "An item is given up on after retry_limit failures"
+
+        for i in range(3):
+            self.make_due()
+            self.post.post_items()
+        attempts, next_attempt, error, dead = self.retry_state()
+        self.assertEqual(attempts, 3)
+        self.assertEqual(next_attempt, None)
+        self.assertTrue(dead)
+        # The feed moves on to its next item
+        pump = FakePump()
+        self.config.accounts["spigot@example.com"] = pump
+        self.post.post_items()
+        self.assertEqual(pump.sent, [("Post #20 - http://example.com/post/20",
+                                      "Post #20")])
+
+
+class FeedHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    "Serves the test feed gzipped, honouring If-None-Match."
+
+    etag = '"spigot-test"'
+
+    def do_GET(self):
+        if self.headers.get("If-None-Match") == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = StringIO.StringIO()
+        gzip_file = gzip.GzipFile(fileobj=body, mode="wb")
+        gzip_file.write(open(SpigotFeedsTest.test_feed).read())
+        gzip_file.close()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/rss+xml")
+        self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body.getvalue())))
+        self.send_header("ETag", self.etag)
+        self.end_headers()
+        self.wfile.write(body.getvalue())
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestHTTPFetch(SpigotFeedsTest):
+
+    def setUp(self):
+        SpigotFeedsTest.setUp(self)
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0),
+                                                FeedHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = "http://127.0.0.1:%d/feed.xml" % self.server.server_port
+        self.config["feeds"][self.url] = self.config["feeds"][self.test_feed]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        SpigotFeedsTest.tearDown(self)
+
+    def test_fetch_gzip(self):
+        "Fetch a gzipped feed over HTTP and store its ETag"
+
+        self.feeds.scan_feed(self.url)
+        self.assertEqual(len(self.db.get_unposted_items(self.url)), 3)
+        self.assertEqual(self.db.get_feed_cache(self.url),
+                         (FeedHandler.etag, None))
+
+    def test_one_commit(self):
+        "Everything learnt from polling a feed is committed at once"
+
+        class CountingConnection(object):
+            def __init__(self, db):
+                self.db = db
+                self.commits = 0
+
+            def commit(self):
+                self.commits += 1
+                self.db.commit()
+
+            def __getattr__(self, attr):
+                return getattr(self.db, attr)
+
+        self.config["settings"].update(adaptive_polling=True,
+                                       incremental_scan=True)
+        self.feeds.record_failure(self.url, "Timed out")
+        self.db._db = CountingConnection(self.db._db)
+        self.feeds.scan_feed(self.url)
+        self.assertEqual(self.db._db.commits, 1)
+        self.assertEqual(len(self.db.get_unposted_items(self.url)), 3)
+        self.assertEqual(self.db.get_feed_cache(self.url),
+                         (FeedHandler.etag, None))
+        self.assertEqual(self.db.get_newest_link(self.url),
+                         "http://example.com/post/21")
+        self.assertEqual(self.db.get_feed_health()[self.url][1], 0)
+
+    def test_stream_gzip(self):
+        "Parse a gzipped feed incrementally as it is downloaded"
+
+        self.config["settings"]["streaming_parse"] = True
+        self.feeds.scan_feed(self.url)
+        self.assertEqual(len(self.db.get_unposted_items(self.url)), 3)
+
+    def test_fetch_not_modified(self):
+        "A feed fetched with its current ETag is not modified"
+
+        p = self.feeds.fetch_feed(self.url, FeedHandler.etag)
+        self.assertEqual(p.status, 304)
+        self.assertEqual(p.entries, [])
+
+
+class DripHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    "Serves the test feed a few bytes at a time, like a stalled server."
+
+    def do_GET(self):
+        body = open(SpigotFeedsTest.test_feed).read()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/rss+xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            for i in range(0, len(body), 64):
+                self.wfile.write(body[i:i + 64])
+                self.wfile.flush()
+                time.sleep(0.2)
+        except socket.error:
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ThreadingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class TestFetchDeadline(SpigotFeedsTest):
+    settings = {"poll_workers": 2, "poll_timeout": 1}
+
+    def setUp(self):
+        SpigotFeedsTest.setUp(self)
+        self.server = ThreadingServer(("127.0.0.1", 0), DripHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.urls = ["http://127.0.0.1:%d/%d.xml" % (self.server.server_port,
+                                                     i) for i in range(2)]
+        for url in self.urls:
+            self.config["feeds"][url] = self.config["feeds"][self.test_feed]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        SpigotFeedsTest.tearDown(self)
+
+    def test_slow_feeds(self):
+        "Slow feeds time out on their own while queued feeds are polled"
+
+        self.feeds.poll_feeds(self.urls + [self.test_feed])
+        self.assertEqual(len(self.db.get_unposted_items(self.test_feed)), 3)
+        health = dict((feed[0], feed[1:]) for feed in
+                      self.feeds.get_health())
+        self.assertEqual(health[self.test_feed][:2], ("ok", 0))
+        for url in self.urls:
+            self.assertEqual(health[url][:2], ("failing", 1))
+
+
+class TestConcurrentPoll(SpigotFeedsTest):
+    settings = {"poll_workers": 4, "poll_timeout": 5}
+
+    def test_poll_feeds(self):
+        "Poll with several workers, including a feed which cannot be read"
+
+        missing_feed = "utils/tests/missing.xml"
+        self.config["feeds"][missing_feed] = dict(
+            self.config["feeds"][self.test_feed])
+        self.feeds.poll_feeds()
+        self.assertEqual(len(self.db.get_unposted_items(self.test_feed)), 3)
+        self.assertEqual(len(self.db.get_unposted_items(missing_feed)), 0)
+
+    def test_hung_fetch(self):
+        "Only feeds whose fetch hangs count as failed, not queued feeds"
+
+        hung_feeds = ["ftp://example.com/1.xml", "ftp://example.com/2.xml"]
+        fetch_feed = self.feeds.fetch_feed
+
+        def hang(url, *args):
+            if url in hung_feeds:
+                time.sleep(3)
+            return fetch_feed(url, *args)
+        self.feeds.fetch_feed = hang
+        self.config["settings"] = {"poll_workers": 2, "poll_timeout": 0.2}
+        for url in hung_feeds:
+            self.config["feeds"][url] = self.config["feeds"][self.test_feed]
+        self.feeds.poll_feeds(hung_feeds + [self.test_feed])
+        self.assertEqual(len(self.db.get_unposted_items(self.test_feed)), 3)
+        health = dict((feed[0], feed[1:]) for feed in
+                      self.feeds.get_health())
+        self.assertEqual(health[self.test_feed][:2], ("ok", 0))
+        for url in hung_feeds:
+            self.assertEqual(health[url][:2], ("failing", 1))
+            self.assertEqual(health[url][-1], "Timed out")
+
+    def test_setting_default(self):
+        "Unconfigured settings fall back to their defaults"
+
+        self.assertEqual(self.config.get_setting("poll_workers"), 4)
+        del self.config["settings"]
+        self.assertEqual(self.config.get_setting("poll_workers"),
+                         spigot.DEFAULT_SETTINGS["poll_workers"])
+
+
+class TestDuePolls(SpigotFeedsTest):
+    settings = {"cron_poll_interval": 15}
+
+    def test_nothing_due(self):
+        "Runs are idle once every feed is polled and posted within interval"
+
+        self.assertEqual(self.feeds.due_polls(), [self.test_feed])
+        self.assertFalse(self.feeds.nothing_due())
+        self.feeds.poll_feeds()
+        self.assertEqual(self.feeds.due_polls(), [])
+        # The feed has unposted items and has never posted
+        self.assertFalse(self.feeds.nothing_due())
+        link = self.db.get_next_items(self.test_feed)[0][1]
+        self.db.mark_posted_items([(link, datetime.datetime.utcnow())])
+        self.assertTrue(self.feeds.nothing_due())
+
+    def test_poll_interval(self):
+        "Feeds are due again once the interval has passed, or always if unset"
+
+        polled = datetime.datetime.utcnow() - datetime.timedelta(minutes=20)
+        self.db.set_poll_time(self.test_feed, polled)
+        self.assertEqual(self.db.get_poll_times(), {self.test_feed: polled})
+        self.assertEqual(self.feeds.due_polls(), [self.test_feed])
+        self.db.set_poll_time(self.test_feed, datetime.datetime.utcnow())
+        self.assertEqual(self.feeds.due_polls(), [])
+        del self.config["settings"]["cron_poll_interval"]
+        self.assertEqual(self.feeds.due_polls(), [self.test_feed])
+
+
+class TestCircuitBreaker(SpigotFeedsTest):
+    settings = {"breaker_threshold": 2, "breaker_delay": 15,
+                "breaker_max_delay": 60}
+    missing_feed = "utils/tests/missing.xml"
+
+    def setUp(self):
+        SpigotFeedsTest.setUp(self)
+        self.config["feeds"][self.missing_feed] = dict(
+            self.config["feeds"][self.test_feed])
+
+    def retry_wait(self):
+        retry_at = self.db.get_retry_times()[self.missing_feed]
+        return retry_at - datetime.datetime.utcnow()
+
+    def test_open_circuit(self):
+        "A feed which keeps failing is retried with exponential backoff"
+
+        self.feeds.poll_feeds()
+        self.assertEqual(self.feeds.get_health()[0][:3],
+                         (self.missing_feed, "failing", 1))
+        self.feeds.poll_feeds()
+        self.assertEqual(self.feeds.get_health()[0][:3],
+                         (self.missing_feed, "open", 2))
+        self.assertTrue(datetime.timedelta(minutes=14) < self.retry_wait() <=
+                        datetime.timedelta(minutes=15))
+        self.assertEqual(self.feeds.due_polls(), [self.test_feed])
+        # Once the retry is due, the feed is probed again
+        self.db._db.execute("UPDATE feeds SET retry_at=? WHERE url=?",
+                            (datetime.datetime.utcnow(), self.missing_feed))
+        self.feeds.poll_feeds()
+        self.assertTrue(datetime.timedelta(minutes=29) < self.retry_wait() <=
+                        datetime.timedelta(minutes=30))
+
+    def test_close_circuit(self):
+        "A successful poll closes the circuit"
+
+        self.feeds.poll_feeds()
+        self.feeds.poll_feeds()
+        self.feeds.handle_feed(self.missing_feed,
+                               self.feeds.fetch_feed(self.test_feed))
+        self.assertEqual(self.db.get_retry_times(), {})
+        health = dict((feed[0], feed[1:3]) for feed in
+                      self.feeds.get_health())
+        self.assertEqual(health[self.missing_feed], ("ok", 0))
+
+    def test_processing_error(self):
+        "An error while processing a feed counts as a failed poll"
+
+        def process_feed(url, p):
+            raise ValueError("bad entry")
+        self.feeds.process_feed = process_feed
+        self.feeds.handle_feed(self.test_feed,
+                               self.feeds.fetch_feed(self.test_feed))
+        health = dict((feed[0], feed[1:]) for feed in self.feeds.get_health())
+        self.assertEqual(health[self.test_feed][:2], ("failing", 1))
+        self.assertEqual(health[self.test_feed][-1], "ValueError: bad entry")
+
+
+class TestIncompleteEntries(SpigotFeedsTest):
+    incomplete_feed = "test-incomplete.xml"
+
+    def setUp(self):
+        SpigotFeedsTest.setUp(self)
+        out = open(self.incomplete_feed, "w")
+        out.write('<?xml version="1.0" encoding="utf-8"?>\n'
+                  '<rss version="2.0"><channel><title>Incomplete</title>'
+                  "<item><title>Undated</title>"
+                  "<link>http://example.net/undated</link></item>"
+                  "<item><title>No link</title>"
+                  "<pubDate>Mon, 30 Jun 2014 12:00:00 GMT</pubDate></item>"
+                  "</channel></rss>\n")
+        out.close()
+        self.config["feeds"][self.incomplete_feed] = dict(
+            self.config["feeds"][self.test_feed])
+
+    def tearDown(self):
+        os.remove(self.incomplete_feed)
+        SpigotFeedsTest.tearDown(self)
+
+    def test_poll_incomplete(self):
+        "Undated entries are added and entries without a link skipped"
+
+        self.feeds.poll_feeds()
+        unposted = self.db.get_unposted_items(self.incomplete_feed)
+        self.assertEqual([item[1] for item in unposted],
+                         ["http://example.net/undated"])
+        self.assertEqual(len(self.db.get_unposted_items(self.test_feed)), 3)
+        health = dict((feed[0], feed[1:3]) for feed in
+                      self.feeds.get_health())
+        self.assertEqual(health[self.incomplete_feed], ("ok", 0))
+
+
+class TestAdaptivePolling(SpigotFeedsTest):
+    settings = {"adaptive_polling": True, "poll_min_interval": 15,
+                "poll_max_interval": 1440}
+
+    def test_quiet_feed(self):
+        "A feed with no recent items is next polled after the longest wait"
+
+        self.feeds.poll_feeds()
+        self.assertEqual(self.feeds.due_polls(), [])
+        polled, rate = self.db.get_poll_state(self.test_feed)
+        wait = self.db.get_next_polls()[self.test_feed] - polled
+        self.assertEqual(wait, datetime.timedelta(minutes=1440))
+        self.assertTrue(rate < 1)
+
+    def test_busy_feed(self):
+        "The wait for the next poll follows the feed's rate of new items"
+
+        dates = [time.gmtime(time.time() - 3600 * i) for i in range(1, 11)]
+        self.feeds.record_poll(self.test_feed, dates, 10)
+        polled, rate = self.db.get_poll_state(self.test_feed)
+        self.assertAlmostEqual(rate, 24, 1)
+        wait = self.db.get_next_polls()[self.test_feed] - polled
+        self.assertAlmostEqual(wait.seconds / 60.0, 60, 0)
+        # An unchanged feed halves the estimated rate
+        self.feeds.record_poll(self.test_feed)
+        polled, rate = self.db.get_poll_state(self.test_feed)
+        self.assertAlmostEqual(rate, 12, 1)
+
+
+class TestWorkers(SpigotFeedsTest):
+    settings = {"workers": 2}
+    # Assigned to worker 0, and the test feed to worker 1
+    other_feed = "http://example.org/feed.xml"
+
+    def setUp(self):
+        SpigotFeedsTest.setUp(self)
+        self.config["feeds"][self.other_feed] = dict(
+            self.config["feeds"][self.test_feed])
+        self.worker = spigot.feed_worker(self.test_feed, 2)
+        self.db.enable_wal()
+        self.other_db = spigot.SpigotDB(path=self.test_db_path)
+
+    def tearDown(self):
+        self.other_db.close()
+        SpigotFeedsTest.tearDown(self)
+
+    def test_feed_worker(self):
+        "Feeds are spread over the workers in the same way every time"
+
+        urls = ["http://example.com/feed/%d" % i for i in range(100)]
+        workers = [spigot.feed_worker(url, 4) for url in urls]
+        self.assertEqual(workers, [spigot.feed_worker(url, 4)
+                                   for url in urls])
+        self.assertEqual(sorted(set(workers)), [0, 1, 2, 3])
+
+    def test_claim_feeds(self):
+        "A worker handles only the feeds assigned to it which it has leased"
+
+        self.config.set_worker(self.worker)
+        self.assertTrue(spigot.claim_feeds(self.config, self.db))
+        self.assertEqual(self.config.leased, set([self.test_feed]))
+        # The other feed is assigned to the other worker
+        self.assertFalse(self.config.handles_feed(self.other_feed))
+        self.assertEqual(self.config.get_feeds(),
+                         [(self.test_feed, "spigot@example.com", 60,
+                           self.test_format)])
+        # Renewing the same leases changes nothing
+        self.assertFalse(spigot.claim_feeds(self.config, self.db))
+
+    def test_leases(self):
+        "A feed leased by one process is skipped by others until it expires"
+
+        self.assertEqual(self.db.acquire_leases([self.test_feed], "a", 600),
+                         [self.test_feed])
+        self.assertEqual(self.other_db.acquire_leases([self.test_feed], "b",
+                                                      600), [])
+        self.assertEqual(self.db.acquire_leases([self.test_feed], "a", -1),
+                         [self.test_feed])
+        self.assertEqual(self.other_db.acquire_leases([self.test_feed], "b",
+                                                      600), [self.test_feed])
+        # Leases are given up when the database is closed
+        self.other_db.close()
+        self.other_db = spigot.SpigotDB(path=self.test_db_path)
+        self.assertEqual(self.db.acquire_leases([self.test_feed], "a", 600),
+                         [self.test_feed])
+
+    def test_wal(self):
+        "Shared databases use write-ahead logging"
+
+        curs = self.db._db.cursor()
+        curs.execute("PRAGMA journal_mode")
+        self.assertEqual(curs.fetchone()[0], "wal")
+        curs.close()
+
+
+class TestMetrics(SpigotFeedsTest):
+    settings = {"metrics_file": "test-metrics.json",
+                "metrics_textfile": "test-metrics.prom"}
+
+    def setUp(self):
+        SpigotFeedsTest.setUp(self)
+        spigot.metrics.reset()
+
+    def tearDown(self):
+        for path in ("test-metrics.json", "test-metrics.prom"):
+            if os.path.exists(path):
+                os.remove(path)
+        SpigotFeedsTest.tearDown(self)
+
+    def test_scan_metrics(self):
+        "Scanning a feed counts its items and times each stage"
+
+        self.feeds.scan_feed(self.test_feed)
+        self.feeds.scan_feed(self.test_feed)
+        summary = spigot.metrics.summary()
+        self.assertEqual(summary["counters"]["entries"][self.test_feed], 6)
+        self.assertEqual(summary["counters"]["items_added"][self.test_feed],
+                         3)
+        for stage in ("parse", "dedup", "render", "insert"):
+            self.assertEqual(summary["timings"][stage][self.test_feed]
+                             ["count"], 2)
+
+    def test_export(self):
+        "Metrics are written as JSON and in the Prometheus text format"
+
+        spigot.metrics.incr("posts", 'a "quoted" feed')
+        spigot.metrics.observe("post", self.test_feed, 0.5)
+        spigot.metrics.export(self.config)
+        summary = spigot.json.loads(open("test-metrics.json").read())
+        self.assertEqual(summary["timings"]["post"][self.test_feed]
+                         ["buckets"]["1"], 1)
+        text = open("test-metrics.prom").read()
+        self.assertTrue('spigot_posts_total{feed="a \\"quoted\\" feed"} 1'
+                        in text)
+        self.assertTrue('le="0.1"} 0' in text)
+        self.assertTrue('le="+Inf"} 1' in text)
+
+
+class TestProfile(SpigotFeedsTest):
+    pstats_path = "test.pstats"
+
+    def tearDown(self):
+        if os.path.exists(self.pstats_path):
+            os.remove(self.pstats_path)
+        SpigotFeedsTest.tearDown(self)
+
+    def test_profile_run(self):
+        "Profile a scan, reporting the time spent in feedparser and SQLite"
+
+        report = StringIO.StringIO()
+        spigot.profile_run(lambda: self.feeds.scan_feed(self.test_feed),
+                           self.pstats_path, 5, report)
+        self.assertTrue(os.path.exists(self.pstats_path))
+        stats = spigot.pstats.Stats(self.pstats_path)
+        breakdown = dict(spigot.profile_breakdown(stats))
+        self.assertTrue(breakdown["feedparser"] > 0)
+        self.assertTrue(breakdown["sqlite3"] > 0)
+        self.assertEqual(breakdown["pypump"], 0)
+        self.assertTrue("feedparser" in report.getvalue())
+        self.assertEqual(len(self.db.get_unposted_items(self.test_feed)), 3)
+
+
+class TestDaemon(SpigotFeedsTest):
+
+    def setUp(self):
+        SpigotFeedsTest.setUp(self)
+        self.daemon = spigot.SpigotDaemon(self.db, self.config, self.feeds,
+                                          None)
+
+    def test_poll_schedules_post(self):
+        "A due poll finds new items and schedules the feed's next post"
+
+        self.daemon.reset()
+        self.daemon.run_pending()
+        self.assertIn(("poll", self.test_feed), self.daemon._due)
+        self.assertIn(("post", self.test_feed), self.daemon._due)
+        next_poll = self.daemon._due[("poll", self.test_feed)]
+        self.assertTrue(next_poll > datetime.datetime.utcnow())
+
+    def test_post_waits_for_interval(self):
+        "A recently posted feed is not scheduled to post until its interval"
+
+        self.feeds.scan_feed(self.test_feed)
+        posted = datetime.datetime.utcnow().replace(microsecond=0)
+        self.db.mark_posted("http://example.com/post/19", posted)
+        self.daemon.schedule_post(self.test_feed)
+        self.assertEqual(self.daemon._due[("post", self.test_feed)],
+                         posted + datetime.timedelta(minutes=60))
+
+    def test_superseded_event(self):
+        "Rescheduling an event replaces the one already queued"
+
+        later = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        self.daemon.reset()
+        self.daemon.schedule("poll", self.test_feed, later)
+        self.daemon.run_pending()
+        self.assertFalse(self.db.has_unposted_items(self.test_feed))
+
+    def test_poll_error(self):
+        "A poll which raises an error is retried shortly"
+
+        def poll_feeds(urls=None):
+            raise sqlite3.OperationalError("database is locked")
+        self.feeds.poll_feeds = poll_feeds
+        self.daemon.reset()
+        self.daemon.run_pending()
+        due = self.daemon._due[("poll", self.test_feed)]
+        self.assertTrue(datetime.datetime.utcnow() < due <=
+                        datetime.datetime.utcnow() + self.daemon.retry_wait)
+
+    def test_auto_prune(self):
+        "The daemon prunes the database when it starts and then daily"
+
+        self.config["settings"] = {"auto_prune": True,
+                                   "retention_per_feed": 1}
+        self.feeds.scan_feed(self.test_feed)
+        for link in ("http://example.com/post/19",
+                     "http://example.com/post/20"):
+            self.db.mark_posted(link)
+        self.daemon.prune_if_due()
+        self.assertEqual(self.db.prune(per_feed=1), 0)
+        # Not pruned again until a day has passed
+        self.db.mark_posted("http://example.com/post/21")
+        self.daemon.prune_if_due()
+        self.assertEqual(self.db.prune(per_feed=1), 1)
 
 
 if __name__ == '__main__':
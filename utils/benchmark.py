@@ -0,0 +1,321 @@
+#! /usr/bin/env python
+# Benchmarks for the ingest, dedup and posting paths of spigot
+#
+# Generates synthetic feeds and databases in a temporary directory, times
+# the main spigot operations against them, and writes the results as JSON
+# so that runs of different versions can be compared with --compare.
+
+import argparse
+from datetime import datetime, timedelta
+try:
+    import json
+except ImportError:
+    import simplejson as json
+import logging
+import os
+import platform
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import spigot  # noqa: E402
+
+FEED_FORMAT = "%title% - %link%"
+TITLE_FORMAT = "%title%"
+
+
+class StubPump(object):
+    """Stands in for a PyPump connection to a pump.io server, accepting every
+    note after an optional delay to simulate network latency."""
+
+    Public = "public"
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.sent = 0
+
+    def Note(self, message, title):
+        pump = self
+
+        class Note(object):
+            def send(self):
+                if pump.latency:
+                    time.sleep(pump.latency)
+                pump.sent += 1
+        return Note()
+
+
+def feed_url(directory, feed_num, kind):
+    return os.path.join(directory, "feed-%d.%s" % (feed_num, kind))
+
+
+def item_link(feed_num, item_num):
+    return "http://feed%d.example.com/post/%d" % (feed_num, item_num)
+
+
+def write_feed(path, feed_num, entries, kind="rss"):
+    """Write a synthetic RSS or Atom feed with the given number of entries,
+    listed newest first."""
+
+    start = datetime(2014, 1, 1)
+    out = open(path, "w")
+    out.write('<?xml version="1.0" encoding="utf-8"?>\n')
+    if kind == "atom":
+        out.write('<feed xmlns="http://www.w3.org/2005/Atom">\n')
+        out.write("<title>Feed %d</title>\n" % feed_num)
+    else:
+        out.write('<rss version="2.0"><channel>\n')
+        out.write("<title>Feed %d</title>\n" % feed_num)
+    for i in range(entries - 1, -1, -1):
+        date = start + timedelta(hours=i)
+        link = item_link(feed_num, i)
+        body = "Body of post %d. " % i * 20
+        if kind == "atom":
+            out.write("<entry><title>Post %d</title>"
+                      '<link href="%s"/><id>%s</id>'
+                      "<updated>%s</updated><content>%s</content></entry>\n"
+                      % (i, link, link, date.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                         body))
+        else:
+            out.write("<item><title>Post %d</title><link>%s</link>"
+                      "<pubDate>%s</pubDate><description>%s</description>"
+                      "</item>\n"
+                      % (i, link, date.strftime("%a, %d %b %Y %H:%M:%S GMT"),
+                         body))
+    if kind == "atom":
+        out.write("</feed>\n")
+    else:
+        out.write("</channel></rss>\n")
+    out.close()
+
+
+def make_config(urls, path):
+    "Return a SpigotConfig holding the given feeds, without saving it."
+
+    config = spigot.SpigotConfig(path)
+    config["feeds"] = {}
+    for num, url in enumerate(urls):
+        config["feeds"][url] = {"account": "bench%d@example.com" % (num % 10),
+                                "interval": 60, "format": FEED_FORMAT,
+                                "title": TITLE_FORMAT}
+    return config
+
+
+def populate_db(path, feeds, rows):
+    """Create a spigot database at path holding the given number of rows
+    spread over the given number of feeds, a tenth of them unposted."""
+
+    db = spigot.SpigotDB(path)
+    db.close()
+    conn = sqlite3.connect(path)
+    feed_ids = []
+    for feed_num in range(feeds):
+        cursor = conn.execute("insert into feeds(url) values (?)",
+                              ["http://feed%d.example.com/feed" % feed_num])
+        feed_ids.append(cursor.lastrowid)
+    start = spigot.to_epoch(datetime(2010, 1, 1))
+    batch = []
+    for i in range(rows):
+        feed_num = i % feeds
+        posted = None
+        if i % 10:
+            posted = start + i * 60
+        batch.append((feed_ids[feed_num], item_link(feed_num, i),
+                      "Post %d" % i, "Post %d" % i, start + i * 60, posted))
+        if len(batch) == 10000:
+            conn.executemany("insert into items(feed_id, link, message, \
+                title, date, posted) values (?, ?, ?, ?, ?, ?)", batch)
+            batch = []
+    conn.executemany("insert into items(feed_id, link, message, title, \
+        date, posted) values (?, ?, ?, ?, ?, ?)", batch)
+    conn.commit()
+    conn.close()
+
+
+def timed(func, repeat=1):
+    """Run func repeat times and return a dict of the best and mean wall
+    clock time in seconds."""
+
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return {"best": min(times), "mean": sum(times) / len(times),
+            "repeat": repeat}
+
+
+def bench_scan_feed(workdir, args):
+    "Time polling every feed into an empty database, then polling again."
+
+    urls = []
+    for num in range(args.feeds):
+        url = feed_url(workdir, num, args.kind)
+        write_feed(url, num, args.entries, args.kind)
+        urls.append(url)
+    db_path = os.path.join(workdir, "scan.db")
+    db = spigot.SpigotDB(db_path)
+    config = make_config(urls, os.path.join(workdir, "spigot.json"))
+    config["settings"] = {"streaming_parse": args.streaming}
+    feeds = spigot.SpigotFeeds(db, config)
+    results = {"new": timed(feeds.poll_feeds),
+               "known": timed(feeds.poll_feeds, args.repeat)}
+    for result in results.values():
+        result["per_entry"] = result["best"] / (args.feeds * args.entries)
+    db.close()
+    return results
+
+
+def bench_db(workdir, args):
+    "Time link lookups and unposted item queries on a populated database."
+
+    db_path = os.path.join(workdir, "populated.db")
+    populate_db(db_path, args.feeds, args.rows)
+    db = spigot.SpigotDB(db_path)
+    lookups = 1000
+    known = [item_link(i % args.feeds, i)
+             for i in range(0, args.rows, max(args.rows / lookups, 1))]
+    unknown = ["http://example.net/missing/%d" % i for i in range(lookups)]
+    feed = "http://feed0.example.com/feed"
+
+    def check_links():
+        for link in known + unknown:
+            db.check_link(link)
+
+    results = {"check_link": timed(check_links, args.repeat),
+               "known_links": timed(lambda: db.known_links(known + unknown),
+                                    args.repeat),
+               "get_unposted_items": timed(
+                   lambda: db.get_unposted_items(feed), args.repeat),
+               "get_next_items": timed(db.get_next_items, args.repeat)}
+    num_links = len(known) + len(unknown)
+    results["check_link"]["per_call"] = (results["check_link"]["best"] /
+                                         num_links)
+    db.enable_link_cache()
+    results["check_link_cached"] = timed(check_links, args.repeat)
+    db.close()
+    results["db_bytes"] = os.path.getsize(db_path)
+    return results
+
+
+def bench_format_element(workdir, args):
+    "Time formatting every entry of one feed."
+
+    url = feed_url(workdir, 0, args.kind)
+    write_feed(url, 0, args.entries, args.kind)
+    config = make_config([url], os.path.join(workdir, "spigot.json"))
+    feeds = spigot.SpigotFeeds(None, config)
+    entries = spigot.feedparser.parse(url).entries
+
+    def format_entries():
+        for entry in entries:
+            feeds.format_element(url, entry, "format")
+            feeds.format_element(url, entry, "title")
+
+    result = timed(format_entries, args.repeat)
+    result["per_entry"] = result["best"] / len(entries)
+    return result
+
+
+def bench_post_items(workdir, args):
+    "Time posting one item from every feed to stub pump.io accounts."
+
+    urls = ["http://feed%d.example.com/feed" % i for i in range(args.feeds)]
+    db_path = os.path.join(workdir, "post.db")
+    db = spigot.SpigotDB(db_path)
+    for num, url in enumerate(urls):
+        db.add_items(url, [(item_link(num, i), "Post %d" % i, "",
+                            datetime(2014, 1, 1) + timedelta(hours=i))
+                           for i in range(args.repeat)], commit=False)
+    db.commit()
+    config = make_config(urls, os.path.join(workdir, "spigot.json"))
+    config["settings"] = {"post_workers": args.post_workers}
+    for num in range(10):
+        config.accounts["bench%d@example.com" % num] = StubPump(args.latency)
+    feeds = spigot.SpigotFeeds(db, config)
+    post = spigot.SpigotPost(db, config, feeds)
+
+    def post_all():
+        post.post_items()
+        # Allow every feed to post again on the next repeat
+        db._db.execute("UPDATE items SET posted = ? \
+            WHERE posted IS NOT NULL", [spigot.to_epoch(datetime(2000, 1, 1))])
+        db.commit()
+
+    result = timed(post_all, args.repeat)
+    result["per_feed"] = result["best"] / args.feeds
+    db.close()
+    return result
+
+
+def compare(results, baseline_path):
+    """Print the ratio of each best time in results to the same time in the
+    baseline results file. Ratios above 1 are slower than the baseline."""
+
+    baseline = json.loads(open(baseline_path).read())
+
+    def walk(new, old, prefix):
+        for key in sorted(new.keys()):
+            if key not in old:
+                continue
+            name = "%s%s" % (prefix, key)
+            if isinstance(new[key], dict) and "best" in new[key]:
+                ratio = new[key]["best"] / max(old[key]["best"], 1e-9)
+                print "%-40s %8.4fs %8.4fs %6.2fx" % (
+                    name, old[key]["best"], new[key]["best"], ratio)
+            elif isinstance(new[key], dict):
+                walk(new[key], old[key], name + ".")
+
+    print "%-40s %9s %9s %7s" % ("benchmark", "baseline", "current",
+                                 "ratio")
+    walk(results["benchmarks"], baseline["benchmarks"], "")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--feeds", type=int, default=10)
+    parser.add_argument("--entries", type=int, default=100)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--kind", choices=["rss", "atom"], default="rss")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--streaming", action="store_true")
+    parser.add_argument("--post-workers", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0)
+    parser.add_argument("--only", action="append",
+                        choices=["scan_feed", "db", "format_element",
+                                 "post_items"])
+    parser.add_argument("--output", "-o")
+    parser.add_argument("--compare")
+    args = parser.parse_args()
+
+    logging.basicConfig(level="ERROR",
+                        format='%(asctime)s %(levelname)s: %(message)s')
+    benchmarks = [("scan_feed", bench_scan_feed), ("db", bench_db),
+                  ("format_element", bench_format_element),
+                  ("post_items", bench_post_items)]
+    results = {"spigot_version": spigot.SPIGOT_VERSION,
+               "python_version": platform.python_version(),
+               "sqlite_version": sqlite3.sqlite_version,
+               "date": datetime.utcnow().isoformat(),
+               "parameters": vars(args),
+               "benchmarks": {}}
+    workdir = tempfile.mkdtemp(prefix="spigot-bench-")
+    try:
+        for name, bench in benchmarks:
+            if args.only and name not in args.only:
+                continue
+            sys.stderr.write("Running %s benchmark\n" % name)
+            results["benchmarks"][name] = bench(workdir, args)
+    finally:
+        shutil.rmtree(workdir)
+
+    output = json.dumps(results, indent=4, sort_keys=True)
+    if args.output:
+        open(args.output, "w").write(output)
+    else:
+        print output
+    if args.compare:
+        compare(results, args.compare)
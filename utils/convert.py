@@ -1,5 +1,6 @@
 #! /usr/bin/env python
-# Tool to upgrade db and config from spigot 2.2 to 2.3+
+# Tool to upgrade config from spigot 2.2 to 2.3+
+# The database is upgraded automatically by spigot itself.
 
 import argparse
 import logging
@@ -9,25 +10,16 @@ except ImportError:
     import simplejson as json
 import os
 import shutil
-import sqlite3
 import sys
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--database", default="spigot.db")
     parser.add_argument("--config", default="spigot.json")
     args = parser.parse_args()
 
     logging.basicConfig(level="INFO",
                         format='%(asctime)s %(levelname)s: %(message)s')
     # Back it up
-    db_bak_file = "%s.bak" % args.database
-    if not os.path.exists(db_bak_file):
-        shutil.copyfile(args.database, db_bak_file)
-        logging.info("DB file backed up to %s" % db_bak_file)
-    else:
-        logging.error("Backup file %s already exists" % db_bak_file)
-        sys.exit(2)
     conf_bak_file = "%s.bak" % args.config
     if not os.path.exists(conf_bak_file):
         shutil.copyfile(args.config, conf_bak_file)
@@ -42,27 +34,6 @@ if __name__ == "__main__":
     except IOError:
         logging.warning("Could not load configuration file")
 
-    # Set up database object
-    det_types = sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
-    try:
-        db = sqlite3.connect(args.database, detect_types=det_types)
-    except:
-        logging.exception("Could not connect to database %s" % args.database)
-        sys.exit(2)
-
-    # Ensure db schema is correct
-    curs = db.cursor()
-    curs.execute("PRAGMA table_info(items);")
-    cols = curs.fetchall()
-    required = "message", "title"
-    for element in required:
-        if element not in [col[1] for col in cols]:
-            curs.execute("ALTER TABLE items ADD COLUMN %s text" % element)
-            logging.info("Added %s column to DB" % element)
-    curs.close()
-    logging.info("Committing database")
-    db.commit()
-
     # Clean up config file
     # Add an empty title element to each feed
     for feed in config["feeds"].keys():
@@ -77,4 +48,4 @@ if __name__ == "__main__":
     logging.info("Writing modified config file")
     open(args.config, "w").write(json.dumps(config, indent=4))
 
-    logging.info("Upgrade of db/config complete.")
+    logging.info("Upgrade of config complete.")